@@ -0,0 +1,53 @@
+import argparse
+import os
+
+from src.batch import BatchRunner, Tile, split_region
+from src.instrumentation import configure
+
+
+def parse_bbox(text):
+    bbox = tuple(float(value) for value in text.split(","))
+    if len(bbox) != 4:
+        raise argparse.ArgumentTypeError(f"expected x0,y0,x1,y1, got {text!r}")
+    return bbox
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the clustering pipeline over tiles of one or more regions.")
+    parser.add_argument("bboxes", nargs="+", type=parse_bbox, help="regions as x0,y0,x1,y1")
+    parser.add_argument("--root", default="batch", help="folder for data, results, images and progress.json")
+    parser.add_argument("--tile-size", type=float, default=0.015, help="tile side in degrees, 0 keeps every bbox whole")
+    parser.add_argument("--overlap", type=float, default=0.002, help="margin around every tile in degrees")
+    parser.add_argument("--workers", type=int, default=2, help="tiles processed at the same time")
+    parser.add_argument("--memory", type=float, default=None, help="allocated memory limit per tile in GiB, split over its processes")
+    parser.add_argument("--max-cache", type=float, default=1, help="cached solutions, datasets and pages per tile in GiB")
+    parser.add_argument("--tiles", nargs="*", default=None, help="only run these tile ids, e.g. to retry a failed one")
+    parser.add_argument("--no-raster", action="store_true", help="render every plot through the browser")
+    parser.add_argument("--trace", action="store_true", help="write a trace.json of spans and counters per tile")
+    parser.add_argument("--trace-memory", action="store_true", help="with --trace, tracemalloc peaks per stage too")
+    parser.add_argument("--profile", default=None, help="folder for a cProfile dump of every grid cell")
+    parser.add_argument("--quiet", action="store_true", help="no progress output")
+    args = parser.parse_args()
+    if args.trace_memory and not args.trace:
+        parser.error("--trace-memory needs --trace")
+    configure(record=args.trace, quiet=args.quiet, trace_memory=args.trace_memory, profile_dir=args.profile)
+
+    tiles = []
+    for bbox in args.bboxes:
+        tiles.extend(split_region(bbox, args.tile_size, args.overlap) if args.tile_size > 0 else [Tile(bbox, 0)])
+    runner = BatchRunner(
+        args.root, tiles, workers=args.workers,
+        n_jobs=max(1, (os.cpu_count() or 1) // args.workers),
+        memory_bytes=int(args.memory * 1024 ** 3) if args.memory is not None else None,
+        max_cache_bytes=int(args.max_cache * 1024 ** 3),
+        raster=not args.no_raster,
+    )
+    runner.run(args.tiles)
+    runner.stitch()
+    failed = [tile.id for tile in tiles if runner.progress.get(tile.id, {}).get("status") != "done"]
+    if failed:
+        print(f"{len(failed)} TILES NOT DONE, rerun with --tiles {' '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import json
+
+from matplotlib import pyplot as plt
+
+
+def load(file_name):
+    with open(file_name) as f:
+        results = json.load(f)
+    return results, {run["size"]: run["stages"] for run in results["runs"]}
+
+
+def compare(baseline, candidate):
+    # seconds per stage and size for two result files, with candidate / baseline
+    (base, base_runs), (cand, cand_runs) = load(baseline), load(candidate)
+    print(f"{'stage':32s} {'size':>10s} {str(base['commit'])[:10]:>10s} {str(cand['commit'])[:10]:>10s} {'ratio':>7s}")
+    for size in sorted(set(base_runs) & set(cand_runs)):
+        for name in base_runs[size]:
+            if name not in cand_runs[size]:
+                continue
+            before, after = base_runs[size][name]["seconds"], cand_runs[size][name]["seconds"]
+            ratio = after / before if before > 0 else float("inf")
+            print(f"{name:32s} {size:10d} {before:10.3f} {after:10.3f} {ratio:7.2f}")
+
+
+def plot(file_name, image_file_name):
+    # log-log seconds against raw points, one line per stage
+    results, runs = load(file_name)
+    sizes = sorted(runs)
+    fig, ax = plt.subplots(figsize=(10, 6))
+    for name in runs[sizes[0]]:
+        points = [(size, runs[size][name]["seconds"]) for size in sizes if name in runs[size]]
+        ax.plot(*zip(*points), marker="o", label=name)
+    ax.set_xscale("log")
+    ax.set_yscale("log")
+    ax.set_xlabel("Raw points")
+    ax.set_ylabel("Seconds")
+    ax.set_title(str(results["commit"])[:12])
+    ax.legend(fontsize=8)
+    plt.tight_layout()
+    plt.savefig(image_file_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare benchmark results or plot their scaling curves.")
+    parser.add_argument("results", nargs="+", help="one file to plot, or a baseline and a candidate to compare")
+    parser.add_argument("--plot", default=None, help="image file for the scaling curves of the last results file")
+    args = parser.parse_args()
+    if len(args.results) == 2:
+        compare(*args.results)
+    if args.plot is not None:
+        plot(args.results[-1], args.plot)
+
+
+if __name__ == "__main__":
+    main()
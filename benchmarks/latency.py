@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import SyntheticTraces  # noqa: E402
+from src.service import LINE_LIMIT  # noqa: E402
+
+
+def chunks(n_points, seed, chunk_size, connections):
+    # synthetic trajectories cut into requests of chunk_size consecutive fixes, as a tracker would
+    # stream them; whole trajectories are dealt round-robin to the connections
+    requests = [[] for _ in range(connections)]
+    for i, (lon, lat, _) in enumerate(SyntheticTraces(n_points, seed).tracks()):
+        xy = np.round(np.column_stack([lon, lat]), 7).tolist()
+        requests[i % connections].extend(xy[start:start + chunk_size] for start in range(0, len(xy), chunk_size))
+    return requests
+
+
+async def stream(host, port, requests, window):
+    # at most window requests in flight; the latency of a request runs from its write to its response
+    reader, writer = await asyncio.open_connection(host, port, limit=LINE_LIMIT)
+    slots = asyncio.Semaphore(window)
+    sent = []
+
+    async def receive():
+        latencies = []
+        for _ in requests:
+            response = json.loads(await reader.readline())
+            if "error" in response:
+                raise RuntimeError(response["error"])
+            latencies.append(time.perf_counter() - sent[response["id"]])
+            slots.release()
+        return latencies
+
+    receiver = asyncio.create_task(receive())
+    for i, points in enumerate(requests):
+        await slots.acquire()
+        sent.append(time.perf_counter())
+        writer.write(json.dumps({"id": i, "points": points}).encode() + b"\n")
+        await writer.drain()
+    latencies = await receiver
+    writer.close()
+    await writer.wait_closed()
+    return latencies
+
+
+async def connect(host, port, timeout):
+    # waits for a service that is still loading its model
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            await writer.wait_closed()
+            return
+        except OSError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def measure(host, port, requests, window):
+    await connect(host, port, 60)
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(stream(host, port, r, window) for r in requests))
+    return time.perf_counter() - start, np.concatenate(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the latency and throughput of the labelling service.")
+    parser.add_argument("--model", default=None, help="start serve.py on this model.npz for the run")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--points", type=int, default=100_000, help="synthetic points streamed in total")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--connections", type=int, default=8, help="trajectory streams at the same time")
+    parser.add_argument("--chunk", type=int, default=20, help="points per request")
+    parser.add_argument("--window", type=int, default=1, help="requests in flight per connection")
+    parser.add_argument("--max-batch", type=int, default=4096, help="passed to serve.py with --model")
+    parser.add_argument("--max-delay", type=float, default=0.0, help="passed to serve.py with --model, in ms")
+    parser.add_argument("--out", default=None, help="JSON file for the results")
+    args = parser.parse_args()
+
+    requests = chunks(args.points, args.seed, args.chunk, args.connections)
+    server = None
+    if args.model is not None:
+        server = subprocess.Popen([
+            sys.executable, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "serve.py"),
+            args.model, "--host", args.host, "--port", str(args.port), "--max-batch", str(args.max_batch),
+            "--max-delay", str(args.max_delay), "--quiet",
+        ])
+    try:
+        seconds, latencies = asyncio.run(measure(args.host, args.port, requests, args.window))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    n_requests, n_points = len(latencies), sum(len(points) for r in requests for points in r)
+    results = {
+        "points": n_points,
+        "requests": n_requests,
+        "connections": args.connections,
+        "chunk": args.chunk,
+        "window": args.window,
+        "seconds": seconds,
+        "points_per_second": n_points / seconds,
+        "requests_per_second": n_requests / seconds,
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            **{f"p{q}": float(np.percentile(latencies, q)) for q in (50, 90, 99)},
+            "max": float(latencies.max()),
+        },
+    }
+    print(f"{n_points} POINTS IN {n_requests} REQUESTS OVER {args.connections} CONNECTIONS: {seconds:.2f} s")
+    print(f"  {results['points_per_second']:.0f} points/s, {results['requests_per_second']:.0f} requests/s")
+    print("  latency " + ", ".join(f"{name} {value:.2f} ms" for name, value in results["latency_ms"].items()))
+    if args.out is not None:
+        os.makedirs(os.path.dirname(args.out) or ".", exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import SyntheticTraces  # noqa: E402
+from src.evaluation import evaluate  # noqa: E402
+from src.scoring import Scoring  # noqa: E402
+from src.solutions import MetricDbscan, Tca  # noqa: E402
+from src.traces import OSMTraces  # noqa: E402
+
+STAGES = [
+    (OSMTraces, "load_raw_data"),
+    (OSMTraces, "clean"),
+    (OSMTraces, "get_data_as_points"),
+    (Tca, "solve"),
+    (Tca, "clean"),
+    (Tca, "cluster_points"),
+    (MetricDbscan, "solve"),
+    (Scoring, "score"),
+]
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageProfiler:
+    # wraps the stage methods on their classes, so the normal pipeline runs unchanged and every
+    # call is measured; outer stages include the time of the stages they call (Tca.solve runs
+    # Tca.clean). Memory is the growth of the process high-water mark during the stage and, with
+    # trace_memory, the tracemalloc peak (slower, so it is opt-in)
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self._originals = []
+
+    def record(self, name, seconds, rss_growth, traced_peak):
+        stage = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "max_rss_growth_mb": 0.0})
+        stage["calls"] += 1
+        stage["seconds"] += seconds
+        stage["max_rss_growth_mb"] = max(stage["max_rss_growth_mb"], rss_growth)
+        if traced_peak is not None:
+            stage["traced_peak_mb"] = max(stage.get("traced_peak_mb", 0.0), traced_peak)
+
+    def measure(self, name, function):
+        @wraps(function)
+        def measured(*args, **kwargs):
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+            rss = max_rss_mb()
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            if name.endswith("get_data_as_points"):
+                result = list(result)  # a generator does its work while it is consumed
+            seconds = time.perf_counter() - start
+            traced = tracemalloc.get_traced_memory()[1] / 1024 ** 2 if self.trace_memory else None
+            self.record(name, seconds, max_rss_mb() - rss, traced)
+            return result
+        return measured
+
+    def __enter__(self):
+        if self.trace_memory:
+            tracemalloc.start()
+        for cls, method in STAGES:
+            original = cls.__dict__.get(method, getattr(cls, method))
+            self._originals.append((cls, method, cls.__dict__.get(method)))
+            setattr(cls, method, self.measure(f"{cls.__name__}.{method}", original))
+        return self
+
+    def __exit__(self, *exc):
+        for cls, method, original in reversed(self._originals):
+            if original is None:
+                delattr(cls, method)
+            else:
+                setattr(cls, method, original)
+        if self.trace_memory:
+            tracemalloc.stop()
+
+
+def run_size(size, seed, root, trace_memory, scoring_mode):
+    # one size end to end: synthetic pages -> load/clean -> points -> TCA -> DBSCAN -> scoring
+    data_root = os.path.join(root, "data", f"{size}_{seed}")
+    results_root = os.path.join(root, "results", f"{size}_{seed}")
+    bbox = SyntheticTraces(size, seed).write(data_root)
+    for file_name in os.listdir(data_root):
+        if file_name.startswith("osm_traces_"):
+            os.remove(os.path.join(data_root, file_name))  # every run cleans from the raw pages
+    shutil.rmtree(results_root, ignore_errors=True)
+    os.makedirs(results_root)
+
+    with StageProfiler(trace_memory) as profiler:
+        traces = OSMTraces(data_root, bbox)
+        traces.get_data_as_points()
+        tca = Tca(results_root, traces, 100, 200, should_cluster=False)
+        tca.cluster_points()
+        dbscan = MetricDbscan(results_root, traces, 30.0, 10)
+        scoring = Scoring(mode=scoring_mode)
+        # the scoring Evaluation runs for every grid cell
+        evaluate(tca, scoring)
+        evaluate(dbscan, scoring)
+    return {
+        "size": size,
+        "raw_points": len(traces.raw),
+        "points": len(traces.points),
+        "trajectories": len(traces.trajectories),
+        "max_rss_mb": max_rss_mb(),
+        "stages": profiler.stages,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every pipeline stage on synthetic trajectories.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10_000, 100_000, 1_000_000],
+                        help="raw points per run, e.g. up to 10000000 for the full scaling curve")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--root", default=os.path.join("benchmarks", "work"), help="generated pages and results")
+    parser.add_argument("--out", default=None, help="JSON file, defaults to benchmarks/results/<commit>.json")
+    parser.add_argument("--trace-memory", action="store_true", help="also record tracemalloc peaks (slower)")
+    parser.add_argument("--scoring", choices=Scoring.MODES, default="sample")
+    args = parser.parse_args()
+
+    commit = git_commit()
+    results = {
+        "commit": commit,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "scoring": args.scoring,
+        "runs": [],
+    }
+    out = args.out or os.path.join("benchmarks", "results", f"{(commit or 'local')[:12]}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    for size in args.sizes:
+        print(f"BENCHMARKING {size} POINTS...")
+        # a fresh process per size, so the high-water marks of one size do not hide the next
+        with ProcessPoolExecutor(max_workers=1, max_tasks_per_child=1) as executor:
+            run = executor.submit(run_size, size, args.seed, args.root, args.trace_memory, args.scoring).result()
+        results["runs"].append(run)
+        for name, stage in run["stages"].items():
+            print(f"  {name:32s} {stage['seconds']:10.3f} s {stage['max_rss_growth_mb']:10.1f} MB")
+        with open(out, "w") as f:
+            json.dump(results, f, indent=2)
+    print(f"RESULTS WRITTEN TO {out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+
+from datetime import datetime, timezone
+
+# a 2 x 2 km block of the default bbox in main.py, with a street every 150 m
+ORIGIN = (106.7052, 10.7982)
+BLOCK = 150
+STREETS = 14
+M_PER_DEG = 111320
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.0" creator="benchmarks" xmlns="http://www.topografix.com/GPX/1/0">\n'
+
+
+class SyntheticTraces:
+    # seeded road-like GPS tracks: vehicles drive along a street grid at 15-50 km/h with a fix every
+    # 5 s, stop for a few minutes at some intersections, lose the signal for 40-90 minutes now and
+    # then and carry about 4 m of GPS noise. Pages hold PAGE_SIZE points with track_fid restarting
+    # in every page, like the OSM trackpoints API
+    PAGE_SIZE = 5000
+
+    def __init__(self, n_points, seed=0, mean_track_points=600, noise=4.0, stop_probability=0.005,
+                 gap_probability=0.002):
+        self.n_points = n_points
+        self.seed = seed
+        self.mean_track_points = mean_track_points
+        self.noise = noise
+        self.stop_probability = stop_probability
+        self.gap_probability = gap_probability
+
+    @property
+    def bbox(self):
+        size = (STREETS - 1) * BLOCK
+        return (
+            ORIGIN[0], ORIGIN[1],
+            round(float(ORIGIN[0] + size / (M_PER_DEG * np.cos(np.radians(ORIGIN[1])))), 7),
+            round(ORIGIN[1] + size / M_PER_DEG, 7),
+        )
+
+    def route(self, rng, length):
+        # intersections visited by a random drive over the grid, in metres
+        node = rng.integers(0, STREETS, 2)
+        heading = np.array([[1, 0], [-1, 0], [0, 1], [0, -1]])[rng.integers(4)]
+        nodes = [node]
+        for _ in range(int(length / BLOCK) + 2):
+            if rng.random() < 0.3:
+                heading = heading[::-1] * rng.choice([-1, 1])
+            if np.any((node + heading < 0) | (node + heading >= STREETS)):
+                heading = -heading
+            node = node + heading
+            nodes.append(node)
+        return np.array(nodes, dtype=float) * BLOCK
+
+    def track(self, rng, n):
+        # (x, y) in metres and seconds since the start for n fixes
+        dt = np.full(n, 5.0)
+        speed = rng.uniform(15, 50) / 3.6 * np.exp(rng.normal(0, 0.1, n))
+        stops = np.flatnonzero(rng.random(n) < self.stop_probability)
+        for stop in stops:
+            speed[stop:stop + rng.integers(12, 60)] = 0
+        gaps = rng.random(n) < self.gap_probability
+        dt[gaps] = rng.uniform(40, 90, gaps.sum()) * 60
+        dt[0] = 0
+        travelled = np.cumsum(np.where(gaps, 5.0, dt) * speed)
+        nodes = self.route(rng, travelled[-1])
+        steps = np.concatenate([[0], np.cumsum(np.abs(np.diff(nodes, axis=0)).sum(axis=1))])
+        x = np.interp(travelled, steps, nodes[:, 0]) + rng.normal(0, self.noise, n)
+        y = np.interp(travelled, steps, nodes[:, 1]) + rng.normal(0, self.noise, n)
+        return x, y, np.cumsum(dt)
+
+    def tracks(self):
+        # per track: lon, lat and POSIX seconds, n_points in total
+        rng = np.random.default_rng(self.seed)
+        start = datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp()
+        total = 0
+        while total < self.n_points:
+            n = int(min(max(rng.exponential(self.mean_track_points), 20), self.n_points - total))
+            x, y, t = self.track(rng, n)
+            lon = ORIGIN[0] + x / (M_PER_DEG * np.cos(np.radians(ORIGIN[1])))
+            lat = ORIGIN[1] + y / M_PER_DEG
+            yield lon, lat, start + rng.integers(0, 365 * 86400) + t
+            total += n
+
+    def write(self, root):
+        # writes tracks(N).gpx pages and returns the bbox; pages already on disk are kept
+        if os.path.exists(os.path.join(root, "tracks(0).gpx")):
+            return self.bbox
+        os.makedirs(root, exist_ok=True)
+        page, parts, size = 0, [], 0
+        for lon, lat, t in self.tracks():
+            start = 0
+            while start < len(lon):
+                end = min(len(lon), start + self.PAGE_SIZE - size)
+                times = np.datetime_as_string((t[start:end] * 1e3).astype("datetime64[ms]"), unit="s")
+                parts.append("<trk><trkseg>\n")
+                parts.extend(
+                    f'<trkpt lat="{b:.7f}" lon="{a:.7f}"><time>{c}Z</time></trkpt>\n'
+                    for a, b, c in zip(lon[start:end], lat[start:end], times)
+                )
+                parts.append("</trkseg></trk>\n")
+                size += end - start
+                start = end
+                if size == self.PAGE_SIZE:
+                    self.write_page(root, page, parts)
+                    page, parts, size = page + 1, [], 0
+        if size > 0:
+            self.write_page(root, page, parts)
+        return self.bbox
+
+    @staticmethod
+    def write_page(root, page, parts):
+        with open(os.path.join(root, f"tracks({page}).gpx"), "w") as f:
+            f.write(HEADER)
+            f.writelines(parts)
+            f.write("</gpx>\n")
@@ -0,0 +1,36 @@
+import argparse
+import asyncio
+import signal
+
+from src.instrumentation import configure, export
+from src.model import Model
+from src.service import LabelService
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Label streamed GPS points against an exported model.")
+    parser.add_argument("model", help="model.npz written next to summary.npz by the pipeline")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch", type=int, default=4096, help="points labelled together at most")
+    parser.add_argument("--max-delay", type=float, default=0.0, help="milliseconds a batch waits for more requests")
+    parser.add_argument("--trace", default=None, help="trace-event JSON of the predict spans, written on exit")
+    parser.add_argument("--quiet", action="store_true", help="no progress output")
+    args = parser.parse_args()
+    configure(record=args.trace is not None, quiet=args.quiet)
+
+    service = LabelService(
+        Model.load(args.model), args.host, args.port, max_points=args.max_batch, max_delay=args.max_delay / 1000
+    )
+    signal.signal(signal.SIGTERM, signal.default_int_handler)  # stopped like Ctrl-C, so the trace is written
+    try:
+        asyncio.run(service.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.trace is not None:
+            export(args.trace)
+
+
+if __name__ == "__main__":
+    main()
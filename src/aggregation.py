@@ -0,0 +1,122 @@
+import movingpandas as mpd
+import numpy as np
+
+from movingpandas.geometry_utils import measure_distance
+from movingpandas.trajectory_aggregator import PtsExtractor, _SequenceGenerator
+from shapely import STRtree
+
+from src.instrumentation import log
+
+# the classes below override internals of movingpandas.trajectory_aggregator, checked against
+# mpd.TrajectoryCollectionAggregator on this minor version (tests/test_aggregation.py)
+TESTED_MOVINGPANDAS = "0.23"
+
+
+class _Track:
+    # memoised distances per point of the track; the memo is dropped when it outgrows this
+    MAX_DISTANCES_PER_POINT = 32
+
+    def __init__(self, traj):
+        self.traj = traj
+        self.points = traj.df[traj.get_geom_col()].tolist()
+        self.times = traj.df.index.to_numpy()
+        self.is_latlon = traj.is_latlon
+        self.start = traj.get_start_location()
+        self._distances = {}
+
+    def distance(self, i, j):
+        # geodesic distances are the expensive part of the extraction and the same (i, j)
+        # pairs come up again for other (min_d, max_d) cells, so they are memoised per track
+        if (i, j) not in self._distances:
+            if len(self._distances) >= self.MAX_DISTANCES_PER_POINT * len(self.points):
+                self._distances.clear()
+            self._distances[(i, j)] = measure_distance(self.points[i], self.points[j], self.is_latlon)
+        return self._distances[(i, j)]
+
+
+class _CachedPtsExtractor(PtsExtractor):
+    def __init__(self, track, max_distance, min_distance, min_stop_duration, min_angle):
+        # PtsExtractor.__init__ would re-read the trajectory frame, everything it needs is in track
+        self.traj = track.traj
+        self.track = track
+        self.n = len(track.points)
+        self.max_distance = max_distance
+        self.min_distance = min_distance
+        self.min_stop_duration = np.timedelta64(min_stop_duration)
+        self.min_angle = min_angle
+        self.significant_points = [track.start, track.points[-1]]
+
+    def get_pt(self, the_loc):
+        return self.track.points[the_loc]
+
+    def distance_greater_than(self, loc1, loc2, dist):
+        return self.track.distance(loc1, loc2) >= dist
+
+    def is_significant_stop(self, j, k):
+        return self.track.times[k - 1] - self.track.times[j] >= self.min_stop_duration
+
+    def append_point(self, pt):
+        if pt != self.track.start:
+            self.significant_points.append(pt)
+
+
+class _IndexedSequenceGenerator(_SequenceGenerator):
+    def __init__(self, cells, traj_collection):
+        self.tree = STRtree(np.asarray(cells.geometry.values))
+        self._nearest = None
+        super().__init__(cells, traj_collection)
+
+    def evaluate_trajectory(self, trajectory):
+        # one bulk nearest-centroid query per trajectory instead of one union search per point;
+        # equidistant centroids resolve to the lowest cell, as the geom_equals lookup does
+        geometry = np.asarray(trajectory.df[trajectory.get_geom_col()].values)
+        input_idx, tree_idx = self.tree.query_nearest(geometry, all_matches=True)
+        nearest = np.full(len(geometry), len(self.cells))
+        np.minimum.at(nearest, input_idx, tree_idx)
+        self._nearest = iter(self.cells.index[nearest])
+        super().evaluate_trajectory(trajectory)
+
+    def get_nearest(self, pt):
+        return next(self._nearest)
+
+
+class _Aggregator(mpd.TrajectoryCollectionAggregator):
+    def __init__(self, engine, max_distance, min_distance, min_stop_duration, min_angle):
+        self.engine = engine
+        super().__init__(engine.traj_collection, max_distance, min_distance, min_stop_duration, min_angle)
+
+    def _extract_significant_points(self):
+        return self.engine.significant_points(self.min_distance, self.max_distance, self.min_stop_duration, self.min_angle)
+
+    def _compute_flows_between_clusters(self):
+        return _IndexedSequenceGenerator(self.get_clusters_gdf(), self.traj_collection).create_flow_lines()
+
+
+class TcaEngine:
+    def __init__(self, traj_collection):
+        self.traj_collection = traj_collection
+        self._tracks = None
+
+    @property
+    def tracks(self):
+        if self._tracks is None:
+            self._tracks = [_Track(traj) for traj in self.traj_collection]
+        return self._tracks
+
+    def significant_points(self, min_distance, max_distance, min_stop_duration, min_angle=45):
+        points = []
+        for track in self.tracks:
+            extractor = _CachedPtsExtractor(track, max_distance, min_distance, min_stop_duration, min_angle)
+            points += extractor.find_significant_points()
+        return points
+
+    def aggregator(self, min_distance, max_distance, min_stop_duration, min_angle=45):
+        # same clusters and flows as mpd.TrajectoryCollectionAggregator, with the per-trajectory
+        # extraction served from this engine's caches; other movingpandas versions get the
+        # original aggregator, as its internals may have changed
+        if not mpd.__version__.startswith(f"{TESTED_MOVINGPANDAS}."):
+            log(f"MOVINGPANDAS {mpd.__version__} IS UNTESTED, USING ITS OWN AGGREGATOR")
+            return mpd.TrajectoryCollectionAggregator(
+                self.traj_collection, max_distance, min_distance, min_stop_duration, min_angle
+            )
+        return _Aggregator(self, max_distance, min_distance, min_stop_duration, min_angle)
@@ -0,0 +1,235 @@
+import json
+import math
+import os
+import resource
+import traceback
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from src.instrumentation import configure, export, log, settings
+from src.pipeline import bbox_folder, run_bbox
+from src.utils import frame_from_arrays, frame_to_arrays
+
+
+class Tile:
+    def __init__(self, core, overlap):
+        # core areas partition the region, the bbox the pipeline runs on adds the overlap margin
+        # so flows crossing a tile border are still seen whole by the tile that owns them
+        self.core = tuple(core)
+        x0, y0, x1, y1 = self.core
+        self.bbox = (round(x0 - overlap, 7), round(y0 - overlap, 7), round(x1 + overlap, 7), round(y1 + overlap, 7))
+
+    @property
+    def id(self):
+        return bbox_folder(self.core)
+
+    def owns(self, geometry):
+        # half-open on the upper edges, so a feature on a shared border belongs to exactly one tile
+        x0, y0, x1, y1 = self.core
+        x, y = shapely.get_x(geometry), shapely.get_y(geometry)
+        return (x >= x0) & (x < x1) & (y >= y0) & (y < y1)
+
+
+def split_region(region, tile_size, overlap=0.0):
+    x0, y0, x1, y1 = region
+    columns = max(1, math.ceil(round((x1 - x0) / tile_size, 9)))
+    rows = max(1, math.ceil(round((y1 - y0) / tile_size, 9)))
+    return [
+        Tile((
+            round(x0 + i * tile_size, 7), round(y0 + j * tile_size, 7),
+            round(min(x0 + (i + 1) * tile_size, x1), 7), round(min(y0 + (j + 1) * tile_size, y1), 7),
+        ), overlap)
+        for j in range(rows) for i in range(columns)
+    ]
+
+
+def _init_tile_worker(memory_bytes, instrumentation):
+    import holoviews as hv
+    import hvplot.pandas  # noqa: F401, registers the .hvplot accessors the plots use
+
+    from holoviews import opts
+
+    if memory_bytes is not None:
+        # a tile that outgrows its budget fails with MemoryError instead of taking the machine down.
+        # RLIMIT_DATA caps the memory actually allocated (heap and private mappings) and not the
+        # address space, which the browser that renders the flow plots reserves in large amounts
+        resource.setrlimit(resource.RLIMIT_DATA, (memory_bytes, memory_bytes))
+    opts.defaults(opts.Overlay(frame_width=765, frame_height=522, fontscale=2))
+    hv.extension("bokeh")
+    configure(**instrumentation)
+
+
+def _run_tile(bbox, n_jobs, max_cache_bytes, roots, raster):
+    from src.rendering import Renderer
+
+    with Renderer(raster=raster, tiles_root=os.path.join(roots["data"], "tiles"), batch=True) as renderer:
+        summary = run_bbox(
+            bbox, renderer=renderer, n_jobs=n_jobs, max_cache_bytes=max_cache_bytes,
+            data_root=roots["data"], results_root=roots["results"], images_root=roots["images"],
+        )
+    # every tile process records its own spans, the trace is kept next to its results
+    export(os.path.join(os.path.dirname(summary), "trace.json"))
+    return summary
+
+
+def merge_clusters(points, tiles):
+    # DBSCAN clusters are numbered per tile and a point in the overlap of two tiles is clustered by
+    # both, so clusters of different tiles that share a point are one cluster across the border.
+    # points holds every tile's points with its tile index; returns the merged cluster id of every
+    # point (-1 for noise), numbered from 0
+    cluster = points["cluster"].to_numpy()
+    offsets = np.zeros(tiles + 1, dtype=int)
+    np.maximum.at(offsets, points["tile"].to_numpy() + 1, cluster + 1)
+    offsets = np.cumsum(offsets)
+    node = np.where(cluster >= 0, offsets[points["tile"].to_numpy()] + cluster, -1)
+    clustered = pd.DataFrame({
+        "x": shapely.get_x(points.geometry.values), "y": shapely.get_y(points.geometry.values), "node": node,
+    })[node >= 0]
+    first = clustered.groupby(["x", "y"])["node"].transform("first").to_numpy()
+    graph = coo_matrix((np.ones(len(first)), (clustered["node"].to_numpy(), first)), shape=(offsets[-1], offsets[-1]))
+    _, component = connected_components(graph, directed=False)
+    merged = np.where(node >= 0, component[np.maximum(node, 0)], -1)
+    _, merged[merged >= 0] = np.unique(merged[merged >= 0], return_inverse=True)
+    return merged
+
+
+class BatchRunner:
+    PROGRESS_FILE_NAME = "progress.json"
+    STITCHED_FILE_NAME = "stitched.npz"
+    # TCA clusters and flows are kept by the tile that owns them, they are not merged
+    NOTE = (
+        "DBSCAN clusters that share points across tile borders are merged (points cluster, label). "
+        "TCA clusters and flows come from the tile whose core contains them and are not merged: a TCA "
+        "cluster crossing a border can appear once per tile."
+    )
+
+    def __init__(self, root, tiles, workers=1, n_jobs=1, memory_bytes=None, max_cache_bytes=None, raster=True):
+        self.root = root
+        self.tiles = tiles
+        self.workers = workers
+        self.n_jobs = n_jobs
+        self.memory_bytes = memory_bytes
+        self.max_cache_bytes = max_cache_bytes
+        self.raster = raster
+        self.roots = {name: os.path.join(root, name) for name in ("data", "results", "images")}
+        self.progress = self.load()
+
+    def load(self):
+        path = os.path.join(self.root, self.PROGRESS_FILE_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self):
+        os.makedirs(self.root, exist_ok=True)
+        path = os.path.join(self.root, self.PROGRESS_FILE_NAME)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.progress, f, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    @property
+    def process_memory_bytes(self):
+        # the tile worker and its n_jobs grid search processes each inherit the limit, so the tile's
+        # budget is split evenly between them; with n_jobs=1 the grid search runs in the tile worker
+        if self.memory_bytes is None:
+            return None
+        return self.memory_bytes // (1 + self.n_jobs) if self.n_jobs > 1 else self.memory_bytes
+
+    def pending(self, only=None):
+        return [
+            tile for tile in self.tiles
+            if self.progress.get(tile.id, {}).get("status") != "done" and (only is None or tile.id in only)
+        ]
+
+    def mark(self, tile, status, **fields):
+        self.progress[tile.id] = {"status": status, "core": tile.core, "bbox": tile.bbox, **fields}
+        self.save()
+
+    def run(self, only=None):
+        # every tile runs in a fresh process (max_tasks_per_child=1), so memory held by one tile is
+        # returned before the next starts; finished tiles are skipped when the batch is run again
+        todo = self.pending(only)
+        log(f"RUNNING {len(todo)}/{len(self.tiles)} TILES...")
+        if not todo:
+            return self.progress
+        with ProcessPoolExecutor(
+            max_workers=self.workers, max_tasks_per_child=1,
+            initializer=_init_tile_worker, initargs=(self.process_memory_bytes, settings()),
+        ) as executor:
+            futures = {
+                executor.submit(_run_tile, tile.bbox, self.n_jobs, self.max_cache_bytes, self.roots, self.raster): tile
+                for tile in todo
+            }
+            for tile in todo:
+                self.mark(tile, "running")
+            for future in as_completed(futures):
+                tile = futures[future]
+                try:
+                    self.mark(tile, "done", summary=future.result())
+                    log(f"TILE {tile.id} DONE")
+                except BrokenProcessPool as e:
+                    self.mark(tile, "failed", error=repr(e))
+                    log(f"TILE {tile.id} FAILED: worker died")
+                except Exception as e:
+                    self.mark(tile, "failed", error="".join(traceback.format_exception(e)))
+                    log(f"TILE {tile.id} FAILED: {e!r}")
+        return self.progress
+
+    def stitch(self):
+        # each tile keeps the flows (by midpoint), clusters and points that fall in its core area;
+        # DBSCAN clusters are then merged across tile borders, see NOTE
+        log("STITCHING TILES...")
+        parts = {"flows": [], "clusters": [], "points": []}
+        owned = []
+        for i, tile in enumerate(self.tiles):
+            entry = self.progress.get(tile.id, {})
+            if entry.get("status") != "done":
+                log(f"SKIPPING TILE {tile.id} ({entry.get('status', 'not run')})")
+                continue
+            with np.load(entry["summary"]) as f:
+                summary = dict(f)
+            for name in parts:
+                gdf = frame_from_arrays(name, summary)
+                anchor = gdf.geometry.values
+                if name == "flows":
+                    anchor = shapely.line_interpolate_point(anchor, 0.5, normalized=True)
+                gdf["tile"] = i
+                if name == "points":
+                    owned.append(tile.owns(anchor))
+                    parts[name].append(gdf)
+                else:
+                    parts[name].append(gdf[tile.owns(anchor)])
+        stitched = {
+            name: gpd.GeoDataFrame(pd.concat(frames, ignore_index=True), crs=frames[0].crs)
+            for name, frames in parts.items() if frames
+        }
+        if "points" in stitched:
+            points = stitched["points"]
+            if "cluster" in points.columns:
+                # labels are cluster sizes, recounted over the points kept after merging
+                points["cluster"] = merge_clusters(points, len(self.tiles))
+                points = points[np.concatenate(owned)].reset_index(drop=True)
+                sizes = np.bincount(points["cluster"][points["cluster"] >= 0], minlength=1)
+                points["label"] = np.where(points["cluster"] >= 0, sizes[np.maximum(points["cluster"], 0)], -1)
+            else:
+                log("SUMMARIES WITHOUT CLUSTER IDS, DBSCAN CLUSTERS ARE NOT MERGED ACROSS TILES")
+                points = points[np.concatenate(owned)].reset_index(drop=True)
+            stitched["points"] = points
+        if stitched:
+            log(self.NOTE)
+            path = os.path.join(self.root, self.STITCHED_FILE_NAME)
+            with open(f"{path}.tmp", "wb") as f:
+                np.savez(f, note=np.array(self.NOTE), **{
+                    key: value for name, gdf in stitched.items() for key, value in frame_to_arrays(name, gdf).items()
+                })
+            os.replace(f"{path}.tmp", path)
+        return stitched
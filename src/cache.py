@@ -0,0 +1,41 @@
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+# bump whenever a code change alters what a cached artifact would contain
+CACHE_VERSION = 1
+
+
+def cache_key(*parts):
+    # numpy scalars repr differently across numpy versions, so plain Python values are hashed
+    parts = [part.item() if isinstance(part, np.generic) else part for part in parts]
+    return hashlib.sha1(repr((CACHE_VERSION, *parts)).encode()).hexdigest()[:12]
+
+
+def file_digest(file_name):
+    digest = hashlib.sha1()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def touch(file_name):
+    # eviction is least-recently-used by mtime, so reads count as uses
+    os.utime(file_name)
+
+
+def evict(root, max_bytes, patterns):
+    # one budget for all files under root matching any of the patterns, oldest first
+    files = sorted(
+        {file_name for pattern in patterns for file_name in glob.glob(os.path.join(root, pattern))},
+        key=os.path.getmtime
+    )
+    total = sum(os.path.getsize(file_name) for file_name in files)
+    for file_name in files:
+        if total <= max_bytes:
+            break
+        total -= os.path.getsize(file_name)
+        os.remove(file_name)
@@ -0,0 +1,101 @@
+import geopandas as gpd
+import movingpandas as mpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from pyproj import Geod
+
+_GEOD = Geod(ellps="WGS84")
+
+
+class CleaningEngine:
+    # the TrajectoryCollection -> add_distance/add_speed -> DouglasPeuckerGeneralizer ->
+    # ObservationGapSplitter -> MIN_POINTS chain on flat arrays grouped by track offsets; the
+    # rows, ids and columns of the result are those of the movingpandas chain, Trajectory
+    # objects are only built for the segments that are kept
+    def __init__(self, tolerance, gap, min_points):
+        self.tolerance = tolerance
+        self.gap = pd.Timedelta(gap).value
+        self.min_points = min_points
+
+    @staticmethod
+    def starts(keys):
+        # True on the first row of every run of equal keys
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        return first
+
+    def tracks(self, raw):
+        # rows sorted by track and time, without repeated timestamps (Trajectory keeps the first)
+        # and without tracks of fewer than two points
+        time = pd.DatetimeIndex(raw["time"]).as_unit("ns").asi8
+        fid = raw["track_fid"].to_numpy()
+        order = np.lexsort((time, fid))
+        order = order[self.starts(fid[order]) | (time[order] != np.roll(time[order], 1))]
+        track = np.cumsum(self.starts(fid[order])) - 1
+        return order[np.bincount(track)[track] >= 2]
+
+    def distance_and_speed(self, x, y, time, first):
+        # geodesic metres from the previous point and km/h, as Trajectory.add_distance(units="m")
+        # and add_speed(units=("km", "h")); the first point of a track takes the speed of the second
+        _, _, distance = _GEOD.inv(np.roll(x, 1), np.roll(y, 1), x, y)
+        same = first | ((x == np.roll(x, 1)) & (y == np.roll(y, 1)))
+        distance = np.where(same, 0.0, distance)
+        seconds = np.diff(time, prepend=time[0]) / 1e9
+        with np.errstate(divide="ignore", invalid="ignore"):
+            speed = np.where(same, 0.0, distance / 1000 / seconds * 3600)
+        heads = np.flatnonzero(first)
+        speed[heads] = speed[heads + 1]
+        return distance, speed
+
+    def generalize(self, x, y, track):
+        # Douglas-Peucker through GEOS for all tracks in one call; like DouglasPeuckerGeneralizer,
+        # a point is kept when its coordinates are among the simplified coordinates of its track
+        lines = shapely.linestrings(np.column_stack([x, y]), indices=track)
+        simplified = shapely.simplify(lines, self.tolerance, preserve_topology=False)
+        coords, index = shapely.get_coordinates(simplified, return_index=True)
+        kept = pd.MultiIndex.from_arrays([index, coords[:, 0], coords[:, 1]])
+        return pd.MultiIndex.from_arrays([track, x, y]).isin(kept)
+
+    def clean(self, raw):
+        if len(raw.index) == 0:
+            return []
+        rows = self.tracks(raw)
+        if len(rows) == 0:
+            return []
+        frame = raw.iloc[rows].reset_index(drop=True)
+        x, y = frame.geometry.x.to_numpy(), frame.geometry.y.to_numpy()
+        time = pd.DatetimeIndex(frame["time"]).as_unit("ns").asi8
+        fid = frame["track_fid"].to_numpy()
+        first = self.starts(fid)
+        track = np.cumsum(first) - 1
+        distance, speed = self.distance_and_speed(x, y, time, first)
+
+        keep = self.generalize(x, y, track)
+        frame = frame[keep].reset_index(drop=True)
+        distance, speed, time, fid, track = distance[keep], speed[keep], time[keep], fid[keep], track[keep]
+
+        # a new segment after every gap, numbered within its track as ObservationGapSplitter does
+        first = self.starts(track)
+        split = first | (np.diff(time, prepend=time[0]) > self.gap)
+        segment = np.cumsum(split) - 1
+        number = segment - segment[first][np.cumsum(first) - 1]
+        sizes = np.bincount(segment)
+        # ObservationGapSplitter drops single points, MIN_POINTS then drops the short segments
+        keep = (sizes[segment] > 1) & (sizes[segment] >= self.min_points)
+
+        data = gpd.GeoDataFrame({
+            "track_fid": fid,
+            "track_seg_id": frame["track_seg_id"].to_numpy(),
+            "track_seg_point_id": frame["track_seg_point_id"].to_numpy(),
+            "geometry": frame.geometry.values,
+            "distance": distance,
+            "speed": speed,
+        }, geometry="geometry", crs=raw.crs, index=pd.DatetimeIndex(frame["time"], name="time"))[keep]
+        segment, number, fid = segment[keep], number[keep], fid[keep]
+        bounds = np.flatnonzero(self.starts(segment)).tolist() + [len(segment)]
+        return [
+            mpd.Trajectory(data.iloc[start:end], f"{fid[start]}_{number[start]}", traj_id_col="track_fid")
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
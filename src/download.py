@@ -0,0 +1,131 @@
+import os
+import re
+import shutil
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from src.cache import file_digest
+from src.instrumentation import count, log, span
+from src.utils import gpx_point_count
+
+EMPTY_GPX = b'<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.0" xmlns="http://www.topografix.com/GPX/1/0"></gpx>\n'
+
+
+def _transient(error):
+    # server errors and rate limiting may pass on a retry, other HTTP errors will not
+    if isinstance(error, HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (URLError, ConnectionError, TimeoutError))
+
+
+class UrllibTransport:
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+
+    def open(self, url):
+        return urlopen(url, timeout=self.timeout)
+
+
+class LocalTransport:
+    # offline stand-in for the trackpoints API: serves tracks(N).gpx fixtures from a directory
+    # and an empty GPX document for pages past the last fixture
+    def __init__(self, directory):
+        self.directory = directory
+
+    def open(self, url):
+        page = int(re.search(r"[?&]page=(\d+)", url).group(1))
+        file_name = os.path.join(self.directory, f"tracks({page}).gpx")
+        if not os.path.exists(file_name):
+            return BytesIO(EMPTY_GPX)
+        return open(file_name, "rb")
+
+
+class Downloader:
+    COMPLETE_FILE_NAME = "download.complete"
+    # trackpoints per page of the API, a shorter page is the last one
+    PAGE_SIZE = 5000
+
+    def __init__(self, root, url, transport=None, max_pages=10, workers=4, retries=3, backoff=1.0,
+                 page_size=PAGE_SIZE):
+        self.root = root
+        self.url = url
+        self.transport = transport if transport is not None else UrllibTransport()
+        self.max_pages = max_pages
+        self.page_size = page_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+
+    def page_file_name(self, page):
+        return os.path.join(self.root, f"tracks({page}).gpx")
+
+    def is_complete(self):
+        return os.path.exists(os.path.join(self.root, self.COMPLETE_FILE_NAME))
+
+    def fetch(self, page, refresh=False):
+        # trackpoints on the page; pages land under their final name only once fully written, so a
+        # page on disk is a completed page and an interrupted run resumes after it. A short page on
+        # disk was the last one and may have grown since, a refresh fetches it again
+        file_name = self.page_file_name(page)
+        if os.path.exists(file_name):
+            points = gpx_point_count(file_name)
+            if not refresh or points >= self.page_size:
+                return points
+            self.get(page, f"{file_name}.tmp")
+            if gpx_point_count(f"{file_name}.tmp") == 0 or file_digest(f"{file_name}.tmp") == file_digest(file_name):
+                os.remove(f"{file_name}.tmp")
+                return points
+            # a new digest, so the incremental load cleans the page again
+            os.replace(f"{file_name}.tmp", file_name)
+            count("pages_refreshed")
+            return gpx_point_count(file_name)
+        self.get(page, f"{file_name}.tmp")
+        points = gpx_point_count(f"{file_name}.tmp")
+        if points == 0:
+            os.remove(f"{file_name}.tmp")
+            return 0
+        os.replace(f"{file_name}.tmp", file_name)
+        count("pages_downloaded")
+        return points
+
+    def get(self, page, file_name):
+        url = f"{self.url}&page={page}"
+        for attempt in range(self.retries + 1):
+            try:
+                log(url)
+                with self.transport.open(url) as response, open(file_name, "wb") as f:
+                    shutil.copyfileobj(response, f)
+                return
+            except OSError as e:
+                if attempt == self.retries or not _transient(e):
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def run(self, refresh=False):
+        # refresh looks for pages past the ones on disk even after a complete download, and fetches
+        # the short last page on disk again; full pages do not change and are not fetched
+        if self.is_complete() and not refresh:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        log("DOWNLOADING...")
+        page, complete = 0, False
+        with span("download", url=self.url), ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while self.max_pages is None or page < self.max_pages:
+                end = page + self.workers
+                if self.max_pages is not None:
+                    end = min(end, self.max_pages)
+                # the last page is short, or an empty document when the points fill whole pages
+                if any(points < self.page_size for points in executor.map(self.fetch, range(page, end), [refresh] * (end - page))):
+                    complete = True
+                    break
+                page = end
+        if not complete:
+            # more pages may follow, a run with a larger max_pages continues from here
+            log(f"STOPPED AFTER {page} PAGES")
+            return
+        with open(os.path.join(self.root, self.COMPLETE_FILE_NAME), "w"):
+            pass
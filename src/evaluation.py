@@ -1,65 +1,185 @@
+import math
 import os
 import pickle
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from matplotlib import pyplot as plt
 from matplotlib.ticker import MaxNLocator
-from sklearn.metrics import silhouette_score, calinski_harabasz_score
+
+from src.cache import cache_key, evict
+from src.instrumentation import configure, count, drain, log, merge, profile, settings, span
+from src.scoring import Scoring
+
+_traj_collection = None
+_shared = {}
+_scoring = None
+
+
+def _init_worker(traj_collection, shared, scoring, instrumentation):
+    # workers keep one copy of the read-only dataset instead of receiving it with every cell
+    global _traj_collection, _shared, _scoring
+    _traj_collection = traj_collection
+    _shared = shared
+    _scoring = scoring
+    configure(**instrumentation)
+
+
+def _evaluate_cell(solution_class, root, p1, p2):
+    # spans and counters recorded in the worker travel back with the score
+    score = evaluate_cell(solution_class, root, _traj_collection, p1, p2, _shared, _scoring)
+    return score, drain()
+
+
+def evaluate_cell(solution_class, root, traj_collection, p1, p2, shared, scoring):
+    with span("cell", solution=solution_class.__name__, p1=p1, p2=p2), \
+            profile(f"{solution_class.__name__}_{p1}_{p2}"):
+        return evaluate(solution_class(root, traj_collection, p1, p2, **shared), scoring)
+
+
+def evaluate(solution, scoring):
+    clusters = set(solution.labels_)
+    if len(clusters) == 1 or (len(clusters) == 2 and -1 in clusters) or len(clusters) > 100: #Nếu chỉ có một cụm, hoặc có hai cụm và một trong số đó là -1 hoặc nhiều hơn 100 cụm => solution tệ, bỏ qua 
+        log(f"POOR SOLUTION ({len(clusters)} CLUSTERS)")
+        return -1, -1
+
+    with span("scoring", points=len(solution.labels_)):
+        return scoring.score(solution.X, solution.labels_, solution.traj_collection.points.traj_id)
 
 
 class Evaluation:
-    def __init__(self, root, traj_collection, solution_class, grid, file_name):
+    SEARCHES = ("grid", "halving")
+    # scores kept in memory and in the results file, the least recently used are dropped first
+    MAX_CELLS = 4096
+
+    def __init__(self, root, traj_collection, solution_class, grid, file_name, n_jobs=1, max_cache_bytes=None,
+                 scoring=None, search="grid", eta=3, rungs=3, random_state=0):
+        if search not in self.SEARCHES:
+            raise ValueError(f"Unknown search {search!r}, expected one of {self.SEARCHES}")
         self.root = root
         self.traj_collection = traj_collection
         self.SolutionClass = solution_class
         self.grid = grid
         self.file_name = file_name
+        self.n_jobs = n_jobs
+        self.max_cache_bytes = max_cache_bytes
+        self.scoring = scoring if scoring is not None else Scoring()
+        self.search = search
+        self.eta = eta
+        self.rungs = rungs
+        self.random_state = random_state
         self.scores = []
+        self.history = []
+        self.cells = {}
 
         self.grid_search()
 
     def _check_exists(self):
         return os.path.exists(os.path.join(self.root, self.file_name))
 
+    def cell_key(self, traj_collection, p1, p2):
+        # every parameter of the solution, not only the grid axes
+        return cache_key(
+            self.SolutionClass.__name__, traj_collection.points.fingerprint,
+            *self.SolutionClass.grid_params(p1, p2), self.scoring.config
+        )
+
+    def remember(self, key, score):
+        # most recently used last, so trimming drops the cells unused for longest
+        self.cells.pop(key, None)
+        self.cells[key] = score
+        for old in list(self.cells)[:max(0, len(self.cells) - self.MAX_CELLS)]:
+            del self.cells[old]
+        return score
+
+    def load(self):
+        if not self._check_exists():
+            return {}
+        log("LOADING RESULTS...")
+        with open(os.path.join(self.root, self.file_name), "rb") as f:
+            return pickle.load(f).get("cells", {})
+
     def save(self):
-        print("SAVING EVALUATION...")
-        with open(os.path.join(self.root, self.file_name), "wb") as f:
-            pickle.dump({"grid": self.grid, "scores": self.scores}, f)
+        # scores are stored per cell key, so a changed grid only evaluates the new cells and an
+        # interrupted search resumes from the last finished one; write-then-rename keeps the
+        # file intact if the run dies mid-write
+        path = os.path.join(self.root, self.file_name)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump({
+                "grid": self.grid, "scores": self.scores, "scoring": self.scoring.config,
+                "search": self.search, "history": self.history, "cells": self.cells,
+            }, f)
+        os.replace(f"{path}.tmp", path)
+
+    def evaluate_cells(self, traj_collection, grid):
+        keys = {(p1, p2): self.cell_key(traj_collection, p1, p2) for p1, p2 in grid}
+        scores = {cell: self.remember(keys[cell], self.cells[keys[cell]]) for cell in grid if keys[cell] in self.cells}
+        todo = [cell for cell in grid if cell not in scores]
+        count("cell_cache_hits", len(grid) - len(todo))
+        count("cell_cache_misses", len(todo))
+        shared = self.SolutionClass.shared_state(traj_collection, todo) if todo else {}
+        if self.n_jobs == 1:
+            for i, (p1, p2) in enumerate(todo):
+                log(f"EVALUATING CELL {i + 1}/{len(todo)} ({p1}, {p2})...")
+                scores[(p1, p2)] = self.remember(keys[(p1, p2)], evaluate_cell(
+                    self.SolutionClass, self.root, traj_collection, p1, p2, shared, self.scoring
+                ))
+                self.save()
+        elif todo:
+            traj_collection.points  # build the point table once, before the workers start
+            with ProcessPoolExecutor(
+                max_workers=self.n_jobs, initializer=_init_worker,
+                initargs=(traj_collection, shared, self.scoring, settings()),
+            ) as executor:
+                futures = {
+                    executor.submit(_evaluate_cell, self.SolutionClass, self.root, p1, p2): (p1, p2)
+                    for p1, p2 in todo
+                }
+                for i, future in enumerate(as_completed(futures)):
+                    score, recorded = future.result()
+                    scores[futures[future]] = self.remember(keys[futures[future]], score)
+                    merge(*recorded)
+                    log(f"EVALUATED CELL {i + 1}/{len(todo)} {futures[future]}")
+                    self.save()
+        return {cell: scores[cell] for cell in grid}, len(todo) > 0
+
+    def successive_halving(self):
+        # every rung scores the surviving candidates on a larger share of the trajectories and
+        # promotes the best 1/eta by silhouette; degenerate settings score -1 in evaluate() before
+        # any metric runs and so drop out on the smallest subsample. Only the last rung sees the
+        # full dataset, candidates eliminated earlier keep the POOR SOLUTION score (-1, -1)
+        candidates = list(self.grid)
+        updated = False
+        for rung in range(self.rungs):
+            fraction = self.eta ** (rung - self.rungs + 1)
+            traj_collection = self.traj_collection if fraction >= 1 else \
+                self.traj_collection.subset(fraction, self.random_state)
+            log(f"HALVING RUNG {rung + 1}/{self.rungs}: {len(candidates)} CANDIDATES ON {len(traj_collection.trajectories)} TRAJECTORIES...")
+            scores, rung_updated = self.evaluate_cells(traj_collection, candidates)
+            updated |= rung_updated
+            self.history.append((fraction, scores))
+            if fraction >= 1:
+                break
+            ranked = sorted(candidates, key=lambda cell: scores[cell][0], reverse=True)
+            candidates = [cell for cell in ranked[:math.ceil(len(ranked) / self.eta)] if scores[cell][0] > -1]
+            if not candidates:
+                break
+        final = self.history[-1][1] if self.history[-1][0] >= 1 else {}
+        return {cell: final.get(cell, (-1, -1)) for cell in self.grid}, updated
 
     def grid_search(self):
-        if self._check_exists():
-            print(f"LOADING RESULTS...")
-            with open(os.path.join(self.root, self.file_name), "rb") as f:
-                results = pickle.load(f)
-                self.scores = results.get("scores")
-                return
-
-        scores = []
-        for i, (p1, p2) in enumerate(self.grid):
-            print("p1", p1)
-            print("p2", p2)
-
-            solution = self.SolutionClass(self.root, self.traj_collection, p1, p2)
-            print("Start solution.solve", i)
-            solution.solve()
-            print("End solution.solve", i)
-            clusters = set(solution.labels_)
-            print("clusters", clusters)
-            if len(clusters) == 1 or (len(clusters) == 2 and -1 in clusters) or len(clusters) > 100: #Nếu chỉ có một cụm, hoặc có hai cụm và một trong số đó là -1 hoặc nhiều hơn 100 cụm => solution tệ, bỏ qua 
-                print("POOR SOLUTION")
-                scores.append((-1,-1))
-                continue
-            
-            print("solution.X", solution.X)
-            print("solution.labels_", solution.labels_)
-            scores.append((
-                silhouette_score(solution.X, solution.labels_),
-                calinski_harabasz_score(solution.X, solution.labels_)
-            ))
-
-            print("scores i = " , scores)
-            del solution
-        self.scores = scores
-        self.save()
+        self.cells = self.load()
+        if self.search == "halving":
+            scores, updated = self.successive_halving()
+        else:
+            scores, updated = self.evaluate_cells(self.traj_collection, self.grid)
+
+        self.scores = [scores[(p1, p2)] for p1, p2 in self.grid]
+        if updated:
+            log("SAVING EVALUATION...")
+            self.save()
+        if self.max_cache_bytes is not None:
+            evict(self.root, self.max_cache_bytes, self.SolutionClass.CACHE_PATTERNS)
+            evict(self.traj_collection.root, self.max_cache_bytes, self.traj_collection.CACHE_PATTERNS)
 
     def plot(self, file_name, nticks=None):
         plt.rcParams["font.family"] = "Arial"
@@ -91,4 +211,5 @@ class Evaluation:
         ax2.set_ylabel("Calinski-Harabasz index", color="r", labelpad=20, fontdict={"style": "italic"})
 
         plt.tight_layout()
-        plt.savefig(file_name)
+        with span("plot", file=file_name):
+            plt.savefig(file_name)
@@ -0,0 +1,200 @@
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager, nullcontext
+
+# nothing is recorded until configure(record=True) and nothing profiled until configure(profile_dir=...);
+# span(), count() and profile() otherwise cost one global lookup, and with quiet=True log() prints
+# nothing either
+_recorder = None
+_profile_dir = None
+_profiler = "cprofile"
+_quiet = False
+_NULL = nullcontext()
+PROFILERS = ("cprofile", "pyinstrument")
+
+
+def _now():
+    # CLOCK_MONOTONIC, shared by the worker processes so their spans line up in one trace
+    return time.perf_counter_ns() // 1000
+
+
+def _max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class _Span:
+    def __init__(self, recorder, name, args):
+        self.recorder = recorder
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        recorder = self.recorder
+        if recorder.trace_memory:
+            # the peak so far belongs to the enclosing span, which gets it back on exit
+            if recorder.stack:
+                recorder.stack[-1].traced = max(recorder.stack[-1].traced, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.traced = 0
+        recorder.stack.append(self)
+        self.rss = _max_rss_mb()
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc):
+        end = _now()
+        recorder = self.recorder
+        recorder.stack.pop()
+        memory = {"max_rss_growth_mb": _max_rss_mb() - self.rss}
+        if recorder.trace_memory:
+            self.traced = max(self.traced, tracemalloc.get_traced_memory()[1])
+            memory["traced_peak_mb"] = self.traced / 1024 ** 2
+            if recorder.stack:
+                recorder.stack[-1].traced = max(recorder.stack[-1].traced, self.traced)
+        recorder.events.append({
+            "name": self.name, "ph": "X", "ts": self.start, "dur": end - self.start,
+            "pid": os.getpid(), "tid": threading.get_ident(), "args": {**self.args, **memory},
+        })
+
+
+class Recorder:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.events = []
+        self.counters = {}
+        self.stack = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.events.append({
+            "name": name, "ph": "C", "ts": _now(), "pid": os.getpid(), "args": {name: self.counters[name]},
+        })
+
+    def drain(self):
+        # events and counters recorded since the last drain, to be merged by the parent process
+        events, counters = self.events, self.counters
+        self.events, self.counters = [], {}
+        return events, counters
+
+    def merge(self, events, counters):
+        self.events.extend(events)
+        for name, value in counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def stages(self):
+        # per span name: calls, total seconds and the largest memory growth of one call
+        stages = {}
+        for event in self.events:
+            if event["ph"] != "X":
+                continue
+            stage = stages.setdefault(event["name"], {"calls": 0, "seconds": 0.0, "max_rss_growth_mb": 0.0})
+            stage["calls"] += 1
+            stage["seconds"] += event["dur"] / 1e6
+            stage["max_rss_growth_mb"] = max(stage["max_rss_growth_mb"], event["args"]["max_rss_growth_mb"])
+            if "traced_peak_mb" in event["args"]:
+                stage["traced_peak_mb"] = max(stage.get("traced_peak_mb", 0.0), event["args"]["traced_peak_mb"])
+        return stages
+
+    def export(self, file_name):
+        # Chrome trace-event format (chrome://tracing, Perfetto), with the summary in otherData
+        with open(f"{file_name}.tmp", "w") as f:
+            json.dump({
+                "traceEvents": self.events,
+                "displayTimeUnit": "ms",
+                "otherData": {"counters": self.counters, "stages": self.stages()},
+            }, f)
+        os.replace(f"{file_name}.tmp", file_name)
+
+
+def configure(record=False, quiet=False, trace_memory=False, profile_dir=None, profiler="cprofile"):
+    # recording (spans and counters for export) and profiling are independent of each other
+    global _recorder, _profile_dir, _profiler, _quiet
+    if profiler not in PROFILERS:
+        raise ValueError(f"Unknown profiler {profiler!r}, expected one of {PROFILERS}")
+    _recorder = Recorder(trace_memory) if record else None
+    _profile_dir = profile_dir
+    _profiler = profiler
+    _quiet = quiet
+    return _recorder
+
+
+def settings():
+    # arguments that configure a worker process like this one
+    return {
+        "record": _recorder is not None, "quiet": _quiet,
+        "trace_memory": _recorder is not None and _recorder.trace_memory,
+        "profile_dir": _profile_dir, "profiler": _profiler,
+    }
+
+
+def recorder():
+    return _recorder
+
+
+def log(message):
+    if not _quiet:
+        print(message)
+
+
+def span(name, **args):
+    if _recorder is None:
+        return _NULL
+    return _Span(_recorder, name, args)
+
+
+def count(name, value=1):
+    if _recorder is not None:
+        _recorder.count(name, value)
+
+
+def profile(name):
+    if _profile_dir is None:
+        return _NULL
+    return _profile(name)
+
+
+@contextmanager
+def _profile(name):
+    os.makedirs(_profile_dir, exist_ok=True)
+    path = os.path.join(_profile_dir, name)
+    if _profiler == "pyinstrument":
+        from pyinstrument import Profiler  # optional, only needed for this profiler
+
+        profiler = Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            with open(f"{path}.html", "w") as f:
+                f.write(profiler.output_html())
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f"{path}.prof")
+
+
+def drain():
+    return _recorder.drain() if _recorder is not None else ([], {})
+
+
+def merge(events, counters):
+    if _recorder is not None:
+        _recorder.merge(events, counters)
+
+
+def export(file_name):
+    if _recorder is not None:
+        _recorder.export(file_name)
@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+
+from pyproj import Transformer
+from sklearn.neighbors import BallTree
+
+from src.instrumentation import count, log, span
+from src.solutions import MetricDbscan
+from src.utils import FlowGrid, frame_from_arrays, frame_to_arrays
+
+
+class Model:
+    # what a fitted Tca and Dbscan need to label points they have not seen: the merged flows with
+    # their weights, and the DBSCAN core points with the id and size of their cluster. A new point
+    # takes the weight of its nearest flow, as Tca.cluster_points labels, and the cluster of its
+    # nearest core point within eps, as DBSCAN labels a border point; otherwise it is noise (-1).
+    # The flow grid is stored with the model, the ball tree is built once when it is loaded
+    FILE_NAME = "model.npz"
+
+    def __init__(self, flows, max_distance, core_xy, core_cluster, core_size, eps, crs=None, leaf_size=40,
+                 flow_grid=None):
+        self.flows = flows
+        self.max_distance = max_distance
+        self.core_xy = core_xy
+        self.core_cluster = core_cluster
+        self.core_size = core_size
+        self.eps = eps
+        self.crs = crs
+        self.leaf_size = leaf_size
+        self.flow_grid = flow_grid if flow_grid is not None else FlowGrid.build(flows)
+        self.tree = BallTree(core_xy, leaf_size=leaf_size) if len(core_xy) > 0 else None
+        # Dbscan clusters lon/lat, MetricDbscan the points projected to a UTM zone
+        self.transformer = Transformer.from_crs("epsg:4326", crs, always_xy=True) if crs else None
+
+    @classmethod
+    def from_solutions(cls, tca, dbscan):
+        X = dbscan.X
+        core, clusters = dbscan.core_and_clusters()
+        crs = dbscan.traj_collection.points.projected_crs.to_string() if isinstance(dbscan, MetricDbscan) else None
+        log(f"EXPORTING {len(tca.flows)} FLOWS AND {int(core.sum())} CORE POINTS...")
+        return cls(
+            tca.flows, tca.max_distance, np.ascontiguousarray(X[core]), np.asarray(clusters)[core],
+            np.asarray(dbscan.labels_)[core], dbscan.eps, crs
+        )
+
+    def save(self, path):
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(
+                f, **frame_to_arrays("flows", self.flows), **self.flow_grid.to_arrays("grid"),
+                max_distance=np.array(np.nan if self.max_distance is None else self.max_distance),
+                core_xy=self.core_xy, core_cluster=self.core_cluster, core_size=self.core_size,
+                eps=np.array(self.eps), crs=np.array(self.crs or ""), leaf_size=np.array(self.leaf_size),
+            )
+        os.replace(f"{path}.tmp", path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            arrays = dict(f)
+        max_distance = float(arrays["max_distance"])
+        flows = frame_from_arrays("flows", arrays)
+        return cls(
+            flows, None if np.isnan(max_distance) else max_distance,
+            arrays["core_xy"], arrays["core_cluster"], arrays["core_size"], float(arrays["eps"]),
+            str(arrays["crs"]) or None, int(arrays["leaf_size"]), FlowGrid.from_arrays("grid", arrays, flows),
+        )
+
+    def predict(self, xy):
+        # xy as (n, 2) longitude, latitude; per point the index and weight of its flow and the id
+        # and size of its DBSCAN cluster
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        with span("predict", points=len(xy)):
+            flow = self.flow_grid.nearest(xy, self.max_distance)
+            cluster = np.full(len(xy), -1, dtype=self.core_cluster.dtype)
+            size = np.full(len(xy), -1, dtype=self.core_size.dtype)
+            if self.tree is not None and len(xy) > 0:
+                X = np.column_stack(self.transformer.transform(xy[:, 0], xy[:, 1])) if self.transformer else xy
+                distance, nearest = self.tree.query(X, k=1)
+                within = distance[:, 0] <= self.eps
+                cluster[within] = self.core_cluster[nearest[within, 0]]
+                size[within] = self.core_size[nearest[within, 0]]
+        count("predicted_points", len(xy))
+        return {"flow": flow, "weight": self.flow_grid.flow_index.weights_of(flow), "cluster": cluster, "size": size}
@@ -0,0 +1,104 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from itertools import product
+
+from src.evaluation import Evaluation
+from src.instrumentation import log
+from src.model import Model
+from src.solutions import MetricDbscan, Tca
+from src.traces import OSMTraces
+from src.utils import frame_to_arrays
+
+SUMMARY_FILE_NAME = "summary.npz"
+
+
+def bbox_folder(bbox):
+    return "_".join([str(b) for b in bbox]).replace(".", ",")
+
+
+def split_track_ids(ids):
+    # cleaned trajectories are named "<track_fid>_<segment>" (CleaningEngine); int() would read
+    # "1_23" as 123, so the two numbers are stored as separate int columns
+    parts = pd.Series(ids).astype(str).str.split("_", n=1, expand=True)
+    return parts[0].astype(np.int64).to_numpy(), parts[1].astype(np.int64).to_numpy()
+
+
+def save_summary(path, tca_params, dbscan_params, flows, clusters, points):
+    with open(f"{path}.tmp", "wb") as f:
+        np.savez(
+            f, tca_params=np.array(tca_params), dbscan_params=np.array(dbscan_params),
+            **frame_to_arrays("flows", flows), **frame_to_arrays("clusters", clusters),
+            **frame_to_arrays("points", points),
+        )
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def run_bbox(bbox, renderer=None, n_jobs=1, max_cache_bytes=None, data_root="data", results_root="results1",
+             images_root="images1", incremental=False):
+    # download -> clean -> TCA/DBSCAN evaluation -> best solutions for one bbox; the best flows,
+    # clusters and labelled points are written to summary.npz in the results folder, and the
+    # model that labels new points to model.npz
+    bbox_subfolder = bbox_folder(bbox)
+    images_folder = os.path.join(images_root, bbox_subfolder)
+    if not os.path.exists(images_folder):
+        os.makedirs(images_folder)
+    results_folder = os.path.join(results_root, bbox_subfolder)
+    if not os.path.exists(results_folder):
+        os.makedirs(results_folder)
+
+    osm_traces = OSMTraces(os.path.join(data_root, bbox_subfolder), bbox, download=True, incremental=incremental)
+    # osm_traces.plot(f"{images_folder}/step_2.png", renderer=renderer)
+    path = os.path.join(results_folder, SUMMARY_FILE_NAME)
+    if len(osm_traces.trajectories) == 0:
+        # nothing to cluster: an empty summary, so a batch of tiles still stitches
+        log("NO TRAJECTORIES IN THE AREA")
+        empty = {"crs": "EPSG:4326", "geometry": gpd.GeoSeries([])}
+        return save_summary(
+            path, [np.nan, np.nan], [np.nan, np.nan],
+            gpd.GeoDataFrame({"weight": np.zeros(0, int), "obj_weight": np.zeros(0, int)}, **empty),
+            gpd.GeoDataFrame({"n": np.zeros(0, int)}, **empty),
+            gpd.GeoDataFrame({
+                "track_fid": np.zeros(0, np.int64), "segment": np.zeros(0, np.int64), "label": np.zeros(0, int),
+                "cluster": np.zeros(0, int),
+            }, **empty),
+        )
+
+    tca_grid = [(min_d, max_d) for min_d, max_d in product(range(50, 450, 50), range(50, 450, 50)) if max_d > min_d]
+    tca_evaluation = Evaluation(results_folder, osm_traces, Tca, tca_grid, "tca.pkl", n_jobs=n_jobs, max_cache_bytes=max_cache_bytes)
+    tca_evaluation.plot(f"{images_folder}/tca.png")
+    best_index = np.argmax(tca_evaluation.scores, axis=0)[0]
+    # summax_index = np.argmax(np.sum(tca_evaluation.scores, axis=1))
+    min_d, max_d = tca_evaluation.grid[best_index]
+    log(f"BEST TCA ({min_d}, {max_d}) OF {len(tca_evaluation.scores)}: {tca_evaluation.scores[best_index]}")
+    # print("tca_evaluation.scores", tca_evaluation.scores[best_index])
+    tca = Tca(results_folder, osm_traces, min_d, max_d, should_cluster=False)
+    tca.plot(f"{images_folder}/tca_{min_d}_{max_d}.png", renderer=renderer)
+    tca.cluster_points()
+    tca.plot(f"{images_folder}/tca_{min_d}_{max_d}_t.png", mode="trajectories", renderer=renderer)
+    # tca.plot(f"{images_folder}/tca_{min_d}_{max_d}_p.png", mode="points", renderer=renderer)
+
+    # eps in metres on the projected points (1e-4..1e-3 degrees is roughly 11..110 m), no per-bbox re-tuning
+    dbscan_grid = list(product(np.linspace(10, 110, 14), np.arange(5, 21, 5)))
+    dbscan_evaluation = Evaluation(results_folder, osm_traces, MetricDbscan, dbscan_grid, "dbscan_m.pkl", n_jobs=n_jobs, max_cache_bytes=max_cache_bytes)
+    dbscan_evaluation.plot(f"{images_folder}/dbscan.png", 15)
+    best_index = np.argmax(dbscan_evaluation.scores, axis=0)[0]
+    # summax_index = np.argmax(np.sum(dbscan_evaluation.scores, axis=1))
+    eps, min_samples = dbscan_evaluation.grid[best_index]
+    log(f"BEST DBSCAN ({eps:.1f}, {min_samples}) OF {len(dbscan_evaluation.scores)}: {dbscan_evaluation.scores[best_index]}")
+    dbscan = MetricDbscan(results_folder, osm_traces, eps, min_samples)
+    dbscan.plot(f"{images_folder}/dbscan_m_{eps:.1f}_{min_samples}_t.png", mode="trajectories", renderer=renderer)
+    # dbscan.plot(f"{images_folder}/dbscan_m_{eps:.1f}_{min_samples}_p.png", mode="points", renderer=renderer)
+
+    points = osm_traces.points.to_gdf(dbscan.labels_)[["track_fid", "label", "geometry"]]
+    points["track_fid"], segment = split_track_ids(points["track_fid"])
+    points.insert(1, "segment", segment)
+    points["cluster"] = dbscan.core_and_clusters()[1]  # ids, so batch.stitch can merge clusters across tiles
+    save_summary(path, [min_d, max_d], [eps, min_samples], tca.flows, tca.clusters, points)
+    # flows and DBSCAN core points of the best solutions, for labelling new points (serve.py)
+    Model.from_solutions(tca, dbscan).save(os.path.join(results_folder, Model.FILE_NAME))
+    return path
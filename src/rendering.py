@@ -0,0 +1,217 @@
+import math
+import os
+
+import holoviews as hv
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from matplotlib import pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+from src.instrumentation import log, span
+
+R_EARTH = 6378137
+TILE_URL = "https://a.basemaps.cartocdn.com/light_all/{z}/{x}/{y}.png"
+
+
+def to_web_mercator(lon, lat):
+    x = R_EARTH * np.radians(lon)
+    y = R_EARTH * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+class TileCache:
+    # CartoLight tiles kept on disk and stitched basemaps kept in memory, so every plot of the
+    # same bbox (and every later run) reuses them instead of fetching the map again
+    TILE_SIZE = 256
+
+    def __init__(self, root, max_tiles=64):
+        self.root = root
+        self.max_tiles = max_tiles
+        self._basemaps = {}
+
+    def tile(self, z, x, y):
+        file_name = os.path.join(self.root, str(z), str(x), f"{y}.png")
+        if not os.path.exists(file_name):
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            request = Request(TILE_URL.format(z=z, x=x, y=y), headers={"User-Agent": "trajectory-clustering"})
+            with urlopen(request, timeout=30) as response, open(f"{file_name}.tmp", "wb") as f:
+                f.write(response.read())
+            os.replace(f"{file_name}.tmp", file_name)
+        return plt.imread(file_name)
+
+    def basemap(self, bounds):
+        # bounds in web mercator metres; returns the stitched image and its extent
+        if bounds in self._basemaps:
+            return self._basemaps[bounds]
+        x0, y0, x1, y1 = bounds
+        world = 2 * math.pi * R_EARTH
+        z = 19
+        while z > 0:
+            columns = math.floor((x1 + world / 2) / world * 2 ** z) - math.floor((x0 + world / 2) / world * 2 ** z) + 1
+            rows = math.floor((world / 2 - y0) / world * 2 ** z) - math.floor((world / 2 - y1) / world * 2 ** z) + 1
+            if columns * rows <= self.max_tiles:
+                break
+            z -= 1
+        tx0 = math.floor((x0 + world / 2) / world * 2 ** z)
+        ty0 = math.floor((world / 2 - y1) / world * 2 ** z)
+        image = np.concatenate([
+            np.concatenate([self.tile(z, tx0 + i, ty0 + j) for i in range(columns)], axis=1)
+            for j in range(rows)
+        ], axis=0)
+        size = world / 2 ** z
+        extent = (tx0 * size - world / 2, (tx0 + columns) * size - world / 2,
+                  world / 2 - (ty0 + rows) * size, world / 2 - ty0 * size)
+        self._basemaps[bounds] = image, extent
+        return image, extent
+
+
+class RasterPlot:
+    # matplotlib rendering of labelled points or trajectories; points are binned to the pixel
+    # grid (highest label per pixel), so the cost does not grow with the number of points drawn
+    MODES = ("points", "trajectories")
+
+    def __init__(self, xy, labels, mode, clabel, groups=None, width=765, height=522, dpi=100):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown raster mode {mode!r}, expected one of {self.MODES}")
+        self.xy = xy
+        self.labels = np.asarray(labels)
+        self.mode = mode
+        self.clabel = clabel
+        self.groups = groups
+        self.width = width
+        self.height = height
+        self.dpi = dpi
+
+    def mercator(self):
+        x, y = to_web_mercator(self.xy[:, 0], self.xy[:, 1])
+        return x, y, (float(x.min()), float(y.min()), float(x.max()), float(y.max()))
+
+    def draw(self, file_name, tiles=None):
+        x, y, bounds = self.mercator()
+        # a bare Figure keeps pyplot's global state out of the way, so plots can be drawn in workers
+        fig = Figure(figsize=(self.width / self.dpi, self.height / self.dpi), dpi=self.dpi)
+        ax = fig.subplots()
+        if tiles is not None:
+            try:
+                image, extent = tiles.basemap(bounds)
+                ax.imshow(image, extent=extent, interpolation="bilinear")
+            except (URLError, OSError):
+                pass  # offline: plot without the basemap
+        vmin, vmax = self.labels.min(), self.labels.max()
+        if self.mode == "points":
+            nx, ny = self.width, self.height
+            ix = np.clip(((x - bounds[0]) / max(bounds[2] - bounds[0], 1e-9) * (nx - 1)).astype(int), 0, nx - 1)
+            iy = np.clip(((y - bounds[1]) / max(bounds[3] - bounds[1], 1e-9) * (ny - 1)).astype(int), 0, ny - 1)
+            grid = np.full((ny, nx), -np.inf)
+            np.maximum.at(grid, (iy, ix), self.labels)
+            artist = ax.imshow(
+                np.ma.masked_invalid(grid), origin="lower", extent=(bounds[0], bounds[2], bounds[1], bounds[3]),
+                cmap="plasma", vmin=vmin, vmax=vmax, interpolation="nearest",
+            )
+        else:
+            # segments between consecutive points of the same trajectory, coloured by the label of
+            # their start and drawn in increasing label order so the busiest flows end up on top
+            same = np.flatnonzero(self.groups[1:] == self.groups[:-1])
+            same = same[np.argsort(self.labels[same], kind="stable")]
+            points = np.column_stack([x, y])
+            segments = np.stack([points[same], points[same + 1]], axis=1)
+            artist = LineCollection(segments, cmap="plasma", linewidths=1, rasterized=True)
+            artist.set_array(self.labels[same])
+            artist.set_clim(vmin, vmax)
+            ax.add_collection(artist)
+        ax.set_xlim(bounds[0], bounds[2])
+        ax.set_ylim(bounds[1], bounds[3])
+        ax.set_axis_off()
+        fig.colorbar(artist, ax=ax, label=self.clabel)
+        fig.savefig(file_name, bbox_inches="tight")
+
+
+def _draw(plot, file_name, tiles):
+    plot.draw(file_name, tiles)
+
+
+class Renderer:
+    # collects plot jobs; holoviews plots go through one headless browser session for the whole
+    # run, raster plots are drawn on a process pool when workers > 1. With batch=True nothing is
+    # rendered until flush() (or the end of a with block)
+    def __init__(self, raster=False, tiles_root="tiles", batch=False, workers=1):
+        self.raster = raster
+        self.tiles = TileCache(tiles_root) if tiles_root is not None else None
+        self.batch = batch
+        self.workers = workers
+        self.jobs = []
+        self._driver = None
+
+    @property
+    def driver(self):
+        if self._driver is None:
+            from bokeh.io.webdriver import webdriver_control
+            if "BOKEH_CHROMEDRIVER_PATH" not in os.environ:
+                from webdriver_manager.chrome import ChromeDriverManager
+                os.environ["BOKEH_CHROMEDRIVER_PATH"] = ChromeDriverManager().install()
+            self._driver = webdriver_control.create("chromium")
+        return self._driver
+
+    def save(self, plot, file_name):
+        self.jobs.append((plot, file_name))
+        if not self.batch:
+            self.flush()
+
+    def flush(self):
+        from bokeh.io import export_png
+
+        jobs, self.jobs = self.jobs, []
+        rasters = [(plot, file_name) for plot, file_name in jobs if isinstance(plot, RasterPlot)]
+        if self.workers > 1 and len(rasters) > 1:
+            # fetch the basemaps first so the workers only read tiles from disk
+            for plot, _ in rasters:
+                self.prefetch(plot)
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(_draw, plot, file_name, self.tiles) for plot, file_name in rasters]
+                with span("plot", plots=len(rasters), backend="raster"):
+                    for future, (_, file_name) in zip(futures, rasters):
+                        future.result()
+                        log(f"RENDERED {file_name}")
+            rasters = []
+        for plot, file_name in rasters:
+            log(f"RENDERING {file_name}...")
+            with span("plot", file=file_name, backend="raster"):
+                plot.draw(file_name, self.tiles)
+        for plot, file_name in jobs:
+            if not isinstance(plot, RasterPlot):
+                log(f"RENDERING {file_name}...")
+                with span("plot", file=file_name, backend="bokeh"):
+                    export_png(hv.render(plot, backend="bokeh"), filename=file_name, webdriver=self.driver)
+
+    def prefetch(self, plot):
+        if self.tiles is None:
+            return
+        try:
+            self.tiles.basemap(plot.mercator()[2])
+        except (URLError, OSError):
+            pass
+
+    def close(self):
+        self.flush()
+        if self._driver is not None:
+            self._driver.quit()
+            self._driver = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def render(plot, file_name, renderer=None):
+    # without a renderer the plot is rendered right away in a session of its own
+    if renderer is not None:
+        renderer.save(plot, file_name)
+        return
+    with Renderer() as renderer:
+        renderer.save(plot, file_name)
@@ -0,0 +1,60 @@
+import numpy as np
+
+from sklearn import config_context
+from sklearn.metrics import calinski_harabasz_score, silhouette_score
+
+
+class Scoring:
+    MODES = ("exact", "sample")
+
+    def __init__(self, mode="exact", sample_size=10000, random_state=0, working_memory=None):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown scoring mode {mode!r}, expected one of {self.MODES}")
+        self.mode = mode
+        self.sample_size = sample_size
+        self.random_state = random_state
+        self.working_memory = working_memory  # MiB per distance chunk, None = sklearn default
+        self._X = None
+        self._sample = None
+
+    @property
+    def config(self):
+        if self.mode == "exact":
+            return {"mode": self.mode, "working_memory": self.working_memory}
+        return {"mode": self.mode, "sample_size": self.sample_size, "random_state": self.random_state}
+
+    def sample(self, strata):
+        # the same number of points per trajectory in proportion to its length (at least one),
+        # drawn reproducibly; it does not depend on the labels, so every grid cell shares it
+        n = len(strata)
+        if n <= self.sample_size:
+            return np.arange(n)
+        rng = np.random.default_rng(self.random_state)
+        order = np.lexsort((rng.random(n), strata))
+        counts = np.bincount(strata)
+        quota = np.minimum(counts, np.maximum(1, np.round(counts * self.sample_size / n).astype(int)))
+        rank = np.arange(n) - np.repeat(np.cumsum(counts) - counts, counts)
+        return np.sort(order[rank < np.repeat(quota, counts)])
+
+    def _sample_points(self, X, strata):
+        # cells with the same X reuse one sample; its distances are computed in chunks per cell
+        # rather than kept as a sample_size x sample_size matrix in every worker
+        if self._X is not X:
+            self._X = X
+            self._sample = self.sample(strata)
+        return self._sample
+
+    def silhouette(self, X, labels, strata):
+        if self.mode == "exact":
+            with config_context(working_memory=self.working_memory):
+                return silhouette_score(X, labels)
+
+        sample = self._sample_points(X, strata)
+        sample_labels = np.asarray(labels)[sample]
+        if not 1 < len(np.unique(sample_labels)) < len(sample):
+            return -1
+        with config_context(working_memory=self.working_memory):
+            return silhouette_score(X[sample], sample_labels)
+
+    def score(self, X, labels, strata):
+        return self.silhouette(X, labels, strata), calinski_harabasz_score(X, labels)
@@ -0,0 +1,129 @@
+import asyncio
+import json
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+
+from src.instrumentation import count, log
+
+# one JSON object per line both ways, so a request of a few thousand points fits in one line
+LINE_LIMIT = 2 ** 24
+
+
+class MicroBatcher:
+    # requests that arrive while a batch is being labelled go into the next batch, up to max_points;
+    # with max_delay > 0 a batch that is not full also waits that many seconds for more requests,
+    # trading latency at low load for larger batches
+    def __init__(self, model, max_points=4096, max_delay=0.0):
+        self.model = model
+        self.max_points = max_points
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        # predict() runs off the event loop, which keeps reading requests meanwhile
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batches = 0
+        self.points = 0
+
+    def submit(self, xy):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((xy, future))
+        return future
+
+    def take(self, batch, size):
+        while size < self.max_points and not self.queue.empty():
+            item = self.queue.get_nowait()
+            batch.append(item)
+            size += len(item[0])
+        return size
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size = self.take(batch, len(batch[0][0]))
+            if self.max_delay > 0 and size < self.max_points:
+                await asyncio.sleep(self.max_delay)
+                size = self.take(batch, size)
+            try:
+                labels = await loop.run_in_executor(
+                    self.executor, self.model.predict, np.concatenate([xy for xy, _ in batch])
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            bounds = np.cumsum([0] + [len(xy) for xy, _ in batch])
+            for (_, future), start, end in zip(batch, bounds[:-1], bounds[1:]):
+                if not future.done():
+                    future.set_result({name: values[start:end] for name, values in labels.items()})
+            self.batches += 1
+            self.points += size
+            count("service_batches")
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class LabelService:
+    # labels streamed trajectories over TCP: every request line is {"id": ..., "points": [[lon, lat], ...]},
+    # usually the next few fixes of a trajectory, and gets back {"id": ..., "flow": [...], "weight": [...],
+    # "cluster": [...], "size": [...]}, or {"id": ..., "error": ...}. Responses keep the request order of
+    # their connection and a client may send more requests before reading the responses
+    def __init__(self, model, host="127.0.0.1", port=8765, max_points=4096, max_delay=0.0):
+        self.model = model
+        self.host = host
+        self.port = port
+        self.max_points = max_points
+        self.max_delay = max_delay
+        self.batcher = None
+
+    async def respond(self, writer, pending):
+        while (item := await pending.get()) is not None:
+            request_id, result = item
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                labels = await result
+                response = {"id": request_id, **{name: values.tolist() for name, values in labels.items()}}
+            except Exception as e:
+                response = {"id": request_id, "error": f"{type(e).__name__}: {e}"}
+            try:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+            except ConnectionError:
+                return  # the client went away, its remaining requests are still labelled and dropped
+
+    async def handle(self, reader, writer):
+        pending = asyncio.Queue()
+        responder = asyncio.create_task(self.respond(writer, pending))
+        try:
+            while line := await reader.readline():
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    request_id = request.get("id")
+                    xy = np.asarray(request["points"], dtype=float).reshape(-1, 2)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    pending.put_nowait((request_id, e))
+                    continue
+                pending.put_nowait((request_id, self.batcher.submit(xy)))
+        finally:
+            pending.put_nowait(None)
+            await responder
+            writer.close()
+
+    async def serve(self):
+        self.batcher = MicroBatcher(self.model, self.max_points, self.max_delay)
+        batcher = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.handle, self.host, self.port, limit=LINE_LIMIT)
+        log(f"LABELLING ON {self.host}:{self.port}...")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.batcher.close()
+            if self.batcher.batches > 0:
+                log(f"{self.batcher.points} POINTS IN {self.batcher.batches} BATCHES")
@@ -1,47 +1,103 @@
+import copy
 import os
-import pickle
 
 import geopandas as gpd
-import holoviews as hv
 import movingpandas as mpd
 import numpy as np
+import pandas as pd
+import shapely
 
 from datetime import timedelta
 from holoviews import dim
-from shapely import LineString
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
 
-from src.utils import find_closest_segment
-import os
-from webdriver_manager.chrome import ChromeDriverManager
-driver_path = ChromeDriverManager().install()
-os.environ["BOKEH_CHROMEDRIVER_PATH"] = driver_path
+from src.aggregation import TcaEngine
+from src.cache import cache_key, touch
+from src.instrumentation import count, log, span
+from src.rendering import RasterPlot, render
+from src.utils import FlowIndex, frame_from_arrays, frame_to_arrays
 
 
 class Solution:
-    GDF_COLUMNS = ["time", "track_fid", "track_seg_id", "track_seg_point_id", "geometry", "label"]
+    # stored solutions of every algorithm, evicted together (Evaluation); the summary and model in
+    # the same folder are not cache files
+    CACHE_PATTERNS = ("tca_*.npz", "dbscan_*.npz")
 
     def __init__(self, root, traj_collection):
         self.root = root
         self.traj_collection = traj_collection
         self.labels_ = []
+        self._traj_collection_clustered = None
 
     @property
     def file_name(self):
-        return f"solution.pkl"
+        return f"solution_{self.key}.npz"
+
+    @property
+    def params(self):
+        return ()
+
+    @classmethod
+    def grid_params(cls, p1, p2):
+        # params of the solution Evaluation builds for the grid cell (p1, p2)
+        return p1, p2
+
+    @property
+    def key(self):
+        # content address of the result: dataset, algorithm, parameters and CACHE_VERSION
+        return cache_key(type(self).__name__, self.traj_collection.points.fingerprint, *self.params)
+
+    @property
+    def traj_collection_clustered(self):
+        # rebuilt from the stored labels only when something (a plot) needs the trajectories
+        if self._traj_collection_clustered is None and len(self.labels_) > 0:
+            self._traj_collection_clustered = mpd.TrajectoryCollection(self.clustered_gdf(), "track_fid", t="time")
+        return self._traj_collection_clustered
+
+    def clustered_gdf(self):
+        return self.traj_collection.points.to_gdf(self.labels_)
 
     @property
     def X(self):
-        traces = list(self.traj_collection.get_data_as_points())
-        return np.array([list(point[-1].coords)[0] for point in traces])
+        return self.coordinates(self.traj_collection.points)
+
+    @classmethod
+    def coordinates(cls, points):
+        return points.xy
+
+    @classmethod
+    def shared_state(cls, traj_collection, grid):
+        # keyword arguments computed once and passed to every solution of a grid search
+        return {}
 
     def _check_exists(self):
         return os.path.exists(os.path.join(self.root, self.file_name))
 
-    def save(self, **kwargs):
-        print("SAVING SOLUTION...")
-        with open(os.path.join(self.root, self.file_name), "wb") as f:
-            pickle.dump(kwargs, f)
+    def save(self, **arrays):
+        log("SAVING SOLUTION...")
+        path = os.path.join(self.root, self.file_name)
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(f"{path}.tmp", path)
+
+    def load(self):
+        if not self._check_exists():
+            return None
+        touch(os.path.join(self.root, self.file_name))
+        with np.load(os.path.join(self.root, self.file_name)) as f:
+            return dict(f)
+
+    def load_previous(self):
+        # the stored result for the dataset this one extends (OSMTraces.base); its points are the
+        # first len(labels) points of the current dataset
+        if self.traj_collection.base is None:
+            return None
+        previous = copy.copy(self)
+        previous.traj_collection = self.traj_collection.base
+        return previous.load()
 
     @classmethod
     def get_plot(cls, traj_collection_clustered, clabel, mode):
@@ -59,105 +115,154 @@ class Solution:
             )
         return None
 
+    def get_raster_plot(self, clabel, mode):
+        # drawn straight from the point table, without building the clustered trajectories
+        points = self.traj_collection.points
+        return RasterPlot(points.xy, self.labels_, mode, clabel, groups=points.traj_id)
+
+    def render(self, file_name, clabel, mode, renderer=None):
+        if renderer is not None and renderer.raster and mode in RasterPlot.MODES:
+            _plot = self.get_raster_plot(clabel, mode)
+        else:
+            _plot = self.get_plot(self.traj_collection_clustered, clabel, mode)
+        render(_plot, file_name, renderer)
+
 
 class Tca(Solution):
-    def __init__(self, root, traj_collection, min_d, max_d, should_cluster=True):
+    MINUTES = 10
+    MAX_DISTANCE = None
+
+    def __init__(self, root, traj_collection, min_d, max_d, should_cluster=True, max_distance=MAX_DISTANCE,
+                 engine=None):
         super().__init__(root, traj_collection)
         self.min_d = min_d
         self.max_d = max_d
-        self.minutes = 10
+        self.minutes = self.MINUTES
         self.should_cluster = should_cluster
+        self.max_distance = max_distance
+        self.engine = engine
 
         self.clusters = None
         self.flows = None
-        self.traj_collection_clustered = None
+        self._flow_index = None
         self.solve()
 
     @property
     def file_name(self):
-        return f"tca_{self.min_d}_{self.max_d}.pkl"
+        return f"tca_{self.min_d}_{self.max_d}_{self.key}.npz"
+
+    @property
+    def params(self):
+        return self.min_d, self.max_d, self.minutes, self.max_distance
+
+    @classmethod
+    def grid_params(cls, p1, p2):
+        return p1, p2, cls.MINUTES, cls.MAX_DISTANCE
+
+    @classmethod
+    def shared_state(cls, traj_collection, grid):
+        # trajectory points, timestamps and distances are extracted once for the whole grid
+        return {"engine": TcaEngine(traj_collection.data)}
+
+    @property
+    def flow_index(self):
+        if self._flow_index is None:
+            self._flow_index = FlowIndex(self.flows)
+        return self._flow_index
 
     def solve(self):
-        if self._check_exists():
-            print(f"LOADING TCA ({self.min_d}, {self.max_d}) SOLUTION...")
-            with open(os.path.join(self.root, self.file_name), "rb") as f:
-                solution = pickle.load(f)
-                self.clusters = solution.get("clusters")
-                self.flows = solution.get("flows")
-                self.traj_collection_clustered = solution.get("traj_collection_clustered")
+        solution = self.load()
+        count("solution_cache_hits" if solution is not None else "solution_cache_misses")
+        if solution is not None:
+            log(f"LOADING TCA ({self.min_d}, {self.max_d}) SOLUTION...")
+            self.clusters = frame_from_arrays("clusters", solution)
+            self.flows = frame_from_arrays("flows", solution)
+            self.labels_ = solution.get("labels", [])
             return
 
-        print(f"SOLVING TCA ({self.min_d}, {self.max_d})...")
-        print(self.traj_collection.data)
-        aggregator = mpd.TrajectoryCollectionAggregator(
-            self.traj_collection.data,
-            min_distance=self.min_d, #khoảng cách tối thiểu giữa các điểm
-            max_distance=self.max_d, #khoảng cách tối đa giữa các điểm
-            min_stop_duration=timedelta(minutes=self.minutes) #thời gian dừng tối thiểu
-        )
-        self.clusters = aggregator.get_clusters_gdf()  #lấy ra các cụm dưới dạng GeoDataFrame
-        print("clusters", self.clusters)
-        self.flows = aggregator.get_flows_gdf() #lấy ra các flow giữa các cụm
-        print("flows", self.flows)
+        previous = self.load_previous()
+        if previous is not None:
+            self.update(previous)
+            return
+
+        log(f"SOLVING TCA ({self.min_d}, {self.max_d}) ON {len(self.traj_collection.trajectories)} TRAJECTORIES...")
+        with span("aggregate", min_d=self.min_d, max_d=self.max_d):
+            engine = self.engine if self.engine is not None else TcaEngine(self.traj_collection.data)
+            aggregator = engine.aggregator(
+                min_distance=self.min_d, #khoảng cách tối thiểu giữa các điểm
+                max_distance=self.max_d, #khoảng cách tối đa giữa các điểm
+                min_stop_duration=timedelta(minutes=self.minutes) #thời gian dừng tối thiểu
+            )
+            self.clusters = aggregator.get_clusters_gdf()  #lấy ra các cụm dưới dạng GeoDataFrame
+            self.flows = aggregator.get_flows_gdf() #lấy ra các flow giữa các cụm
+        count("clusters", len(self.clusters))
+        log(f"{len(self.clusters)} CLUSTERS, {len(self.flows)} FLOWS")
         self.clean()
         if self.should_cluster:
             self.cluster_points()
         else:
-            self.save(clusters=self.clusters, flows=self.flows)
+            self.save(**frame_to_arrays("clusters", self.clusters), **frame_to_arrays("flows", self.flows))
+
+    def update(self, previous):
+        # flows and clusters are kept, only the appended points are labelled against them
+        log(f"UPDATING TCA ({self.min_d}, {self.max_d}) SOLUTION...")
+        self.clusters = frame_from_arrays("clusters", previous)
+        self.flows = frame_from_arrays("flows", previous)
+        if "labels" in previous:
+            appended = self.traj_collection.points.geometry[len(previous["labels"]):]
+            with span("label_points", points=len(appended)):
+                labels = self.flow_index.query(appended, self.max_distance)
+            count("labelled_points", len(appended))
+            self.labels_ = np.concatenate([previous["labels"], labels])
+            self.save(
+                **frame_to_arrays("clusters", self.clusters), **frame_to_arrays("flows", self.flows),
+                labels=self.labels_
+            )
+        elif self.should_cluster:
+            self.cluster_points()
+        else:
+            self.save(**frame_to_arrays("clusters", self.clusters), **frame_to_arrays("flows", self.flows))
 
     def clean(self):
-        print("CLEANING TCA SOLUTION...")
-        merged_flows = []
-        visited = set()
-    
-        for i, row_i in self.flows.iterrows():
-            if i in visited:
-                continue
-    
-            line_i = row_i["geometry"]
-            weight = row_i["weight"]
-            obj_weight = row_i["obj_weight"]
-    
-            for j, row_j in self.flows.iterrows(): #kiểm tra nếu có flow nào khác trùng nhưng ngược chiều ko
-                line_j = row_j["geometry"]
-                if i != j and j not in visited and line_i.equals(LineString(line_j.coords[::-1])):
-                    weight += row_j["weight"]
-                    obj_weight += row_j["obj_weight"] #nếu có thì cộng thêm weight, obj_weight của flow j vào flow i
-                    visited.add(j)
-    
-            merged_flows.append({
-                "geometry": line_i,
-                "weight": weight,
-                "obj_weight": obj_weight,
-            })
-    
-        self.flows = gpd.GeoDataFrame(merged_flows)
-        self.flows.sort_values("weight", ignore_index=True)
+        with span("flow_merge", flows=len(self.flows)):
+            self.merge_flows()
+        count("flows", len(self.flows))
+
+    def merge_flows(self):
+        # a flow and its reverse share the same endpoint pair once the endpoints are put in a
+        # canonical order, so grouping on that key merges them and sums their weights
+        geometry = self.flows.geometry.values
+        start = shapely.get_coordinates(shapely.get_point(geometry, 0))
+        end = shapely.get_coordinates(shapely.get_point(geometry, -1))
+        forward = (start[:, 0] < end[:, 0]) | ((start[:, 0] == end[:, 0]) & (start[:, 1] <= end[:, 1]))
+        low = np.where(forward[:, None], start, end)
+        high = np.where(forward[:, None], end, start)
+        groups = self.flows.groupby([low[:, 0], low[:, 1], high[:, 0], high[:, 1]], sort=False)
+        # groups come out in order of first appearance, which is the flow the old loop kept
+        first = self.flows.loc[groups.cumcount() == 0, ["geometry"]].reset_index(drop=True)
+        weights = groups[["weight", "obj_weight"]].sum().reset_index(drop=True)
+        self.flows = gpd.GeoDataFrame(pd.concat([first, weights], axis=1), geometry="geometry", crs=self.flows.crs)
 
     def cluster_points(self):
-        if self.traj_collection_clustered is not None:
+        if len(self.labels_) > 0:
             return
 
-        print("CLUSTERING POINTS...")
-        traces = []
-        self.labels_ = []
-        for point in self.traj_collection.get_data_as_points():
-            weight = find_closest_segment(self.flows, point[-1])
-            traces.append([*point, weight])
-            self.labels_.append(weight)
-        gdf = gpd.GeoDataFrame(
-            traces,
-            columns=Tca.GDF_COLUMNS,
-            geometry="geometry",
-            crs="epsg:4326"
+        log("CLUSTERING POINTS...")
+        # points farther than max_distance from every flow are labelled -1 (noise)
+        with span("label_points", points=len(self.traj_collection.points)):
+            self.labels_ = self.flow_index.query(self.traj_collection.points.geometry, self.max_distance)
+        count("labelled_points", len(self.labels_))
+        self.save(
+            **frame_to_arrays("clusters", self.clusters), **frame_to_arrays("flows", self.flows), labels=self.labels_
         )
+
+    def clustered_gdf(self):
+        gdf = super().clustered_gdf()
         gdf["max"] = gdf.groupby("track_fid")["label"].transform("max")
-        gdf = gdf.sort_values("max", ascending=False).drop("max", axis=1)
-        self.traj_collection_clustered = mpd.TrajectoryCollection(gdf, "track_fid", t="time")
-        self.save(clusters=self.clusters, flows=self.flows, traj_collection_clustered=self.traj_collection_clustered)
+        return gdf.sort_values("max", ascending=False).drop("max", axis=1)
 
-    def plot(self, file_name, mode="flow"):
-        print("PLOTTING TCA SOLUTION...")
+    def plot(self, file_name, mode="flow", renderer=None):
+        log("PLOTTING TCA SOLUTION...")
         if mode == "flow":
             _plot = self.flows.hvplot(
                 geo=True, c="weight", line_width=3,
@@ -167,51 +272,162 @@ class Tca(Solution):
                 geo=True, color="blue", alpha=dim("n").norm().clip(min=0.3),
                 size=dim("n").norm().clip(min=0.2) * 28
             )
+            render(_plot, file_name, renderer)
         else:
-            _plot = self.get_plot(self.traj_collection_clustered, "Number of trajectories", mode)
-        hv.save(_plot, file_name)
+            self.render(file_name, "Number of trajectories", mode, renderer)
 
 
 class Dbscan(Solution):
-    def __init__(self, root, traj_collection, eps, min_samples):
+    def __init__(self, root, traj_collection, eps, min_samples, neighbors=None):
         super().__init__(root, traj_collection)
         self.eps = eps
         self.min_samples = min_samples
-
-        self.traj_collection_clustered = None
+        self.neighbors = neighbors
         self.solve()
 
     @property
     def file_name(self):
-        return f"dbscan_{self.eps:.5f}_{self.min_samples}.pkl"
+        return f"dbscan_{self.eps:.5f}_{self.min_samples}_{self.key}.npz"
+
+    @property
+    def params(self):
+        return self.eps, self.min_samples
+
+    @classmethod
+    def shared_state(cls, traj_collection, grid):
+        # one radius-neighbours graph at the largest eps; DBSCAN(metric="precomputed") only
+        # keeps the edges within its own eps, so every (eps, min_samples) cell reuses it
+        log("BUILDING NEIGHBOURS GRAPH...")
+        max_eps = max(eps for eps, _ in grid)
+        with span("neighbours_graph", eps=max_eps):
+            nn = NearestNeighbors(radius=max_eps).fit(cls.coordinates(traj_collection.points))
+            return {"neighbors": nn.radius_neighbors_graph(mode="distance")}
 
     def solve(self):
-        if self._check_exists():
-            print(f"LOADING DBSCAN ({self.eps:.5f}, {self.min_samples}) SOLUTION...")
-            with open(os.path.join(self.root, self.file_name), "rb") as f:
-                solution = pickle.load(f)
-                self.traj_collection_clustered = solution.get("traj_collection_clustered")
+        solution = self.load()
+        count("solution_cache_hits" if solution is not None else "solution_cache_misses")
+        if solution is not None:
+            log(f"LOADING DBSCAN ({self.eps:.5f}, {self.min_samples}) SOLUTION...")
+            self.labels_ = solution["labels"]
             return
 
-        print(f"SOLVING DBSCAN ({self.eps:.5f}, {self.min_samples})...")
-        db = DBSCAN(eps=self.eps, min_samples=self.min_samples)
-        db.fit(self.X)
-        unique, counts = np.unique(db.labels_, return_counts=True)
+        previous = self.load_previous()
+        if previous is not None and "core" in previous:
+            with span("dbscan_update", eps=self.eps, min_samples=self.min_samples):
+                updated = self.update(previous)
+            if updated:
+                return
+
+        log(f"SOLVING DBSCAN ({self.eps:.5f}, {self.min_samples})...")
+        with span("dbscan_fit", eps=self.eps, min_samples=self.min_samples):
+            if self.neighbors is None:
+                db = DBSCAN(eps=self.eps, min_samples=self.min_samples)
+                db.fit(self.X)
+            else:
+                db = DBSCAN(eps=self.eps, min_samples=self.min_samples, metric="precomputed")
+                db.fit(self.neighbors)
+        core = np.zeros(len(db.labels_), dtype=bool)
+        core[db.core_sample_indices_] = True
+        self.finish(db.labels_, core)
+
+    def finish(self, clusters, core):
+        # labels are cluster sizes; the raw cluster ids and the core mask are kept for update()
+        unique, counts = np.unique(clusters, return_counts=True)
+        count("clusters", int(np.sum(unique >= 0)))
         mapping = dict(zip(unique, counts))
         mapping[-1] = -1
         mp = np.vectorize(lambda el: mapping[el])
-        self.labels_ = mp(db.labels_)
-        traces = list(self.traj_collection.get_data_as_points())
-        gdf = gpd.GeoDataFrame(
-            [(*point, label) for point, label in zip(traces, self.labels_)],
-            columns=Dbscan.GDF_COLUMNS,
-            geometry="geometry",
-            crs="epsg:4326"
-        )
-        self.traj_collection_clustered = mpd.TrajectoryCollection(gdf, "track_fid", t="time")
-        self.save(traj_collection_clustered=self.traj_collection_clustered)
+        self.labels_ = mp(clusters)
+        self.save(labels=self.labels_, clusters=clusters, core=core)
+
+    def core_and_clusters(self):
+        # the core mask and the cluster ids behind labels_ (cluster sizes); solutions stored before
+        # they were kept are fitted again
+        stored = self.load() or {}
+        if "core" in stored and "clusters" in stored:
+            return stored["core"], stored["clusters"]
+        db = DBSCAN(eps=self.eps, min_samples=self.min_samples).fit(self.X)
+        core = np.zeros(len(db.labels_), dtype=bool)
+        core[db.core_sample_indices_] = True
+        return core, db.labels_
+
+    def update(self, previous):
+        # incremental DBSCAN (Ester et al., 1998) for appended points: neighbourhoods only grow,
+        # so cores stay cores, new cores merge the clusters they reach, and noise within reach of
+        # a core becomes a border point. Old border points keep their cluster, which full DBSCAN
+        # may also assign to a different neighbouring cluster
+        if not self.same_coordinates():
+            return False
+        X = self.X
+        log(f"UPDATING DBSCAN ({self.eps:.5f}, {self.min_samples}) SOLUTION...")
+        n_old, n = len(previous["clusters"]), len(X)
+        appended = np.arange(n_old, n)
+        nn = NearestNeighbors(radius=self.eps).fit(X)
+
+        # old points with an appended neighbour have new neighbour counts
+        reached = nn.radius_neighbors(X[appended], return_distance=False)
+        touched = np.unique(np.concatenate([appended, *reached])).astype(int)
+        neighbors = dict(zip(touched, nn.radius_neighbors(X[touched], return_distance=False)))
+        core = np.concatenate([previous["core"], np.zeros(len(appended), dtype=bool)])
+        was_core = core.copy()
+        core[touched] = [len(neighbors[i]) >= self.min_samples for i in touched]
+        new_cores = touched[core[touched] & ~was_core[touched]]
+
+        # one node per old cluster and per new core, joined along core-core edges of the new cores
+        old_clusters = previous["clusters"]
+        n_clusters = old_clusters.max() + 1 if n_old > 0 else 0
+        node = np.full(n, -1)
+        node[:n_old][was_core[:n_old]] = old_clusters[was_core[:n_old]]
+        node[new_cores] = n_clusters + np.arange(len(new_cores))
+        rows, columns = [], []
+        for i in new_cores:
+            reach = neighbors[i][core[neighbors[i]]]
+            rows.extend([node[i]] * len(reach))
+            columns.extend(node[reach])
+        n_nodes = n_clusters + len(new_cores)
+        graph = coo_matrix((np.ones(len(rows)), (rows, columns)), shape=(n_nodes, n_nodes))
+        _, component = connected_components(graph, directed=False)
+
+        clusters = np.full(n, -1)
+        # an all-noise previous solution has no nodes unless new cores appeared
+        old = old_clusters >= 0
+        clusters[:n_old][old] = component[old_clusters[old]]
+        clusters[core] = component[node[core]]
+        # noise (old or appended) next to a core becomes a border point of its lowest-index core
+        candidates = set(appended) | {j for i in new_cores for j in neighbors[i]}
+        for i in sorted(candidates):
+            if core[i] or clusters[i] >= 0:
+                continue
+            if i not in neighbors:
+                neighbors[i] = nn.radius_neighbors(X[[i]], return_distance=False)[0]
+            reach = np.sort(neighbors[i][core[neighbors[i]]])
+            if len(reach) > 0:
+                clusters[i] = clusters[reach[0]]
+        _, clusters[clusters >= 0] = np.unique(clusters[clusters >= 0], return_inverse=True)
+        self.finish(clusters, core)
+        return True
+
+    def same_coordinates(self):
+        return True
+
+    def plot(self, file_name, mode="points", renderer=None):
+        log("PLOTTING DBSCAN SOLUTION...")
+        self.render(file_name, "Number of points", mode, renderer)
+
+
+class MetricDbscan(Dbscan):
+    # eps in metres on the projected points, so one parameter grid transfers between regions
+    @property
+    def file_name(self):
+        return f"dbscan_m_{self.eps:.1f}_{self.min_samples}_{self.key}.npz"
+
+    @classmethod
+    def coordinates(cls, points):
+        return points.projected
 
-    def plot(self, file_name, mode="points"):
-        print("PLOTTING DBSCAN SOLUTION...")
-        _plot = self.get_plot(self.traj_collection_clustered, "Number of points", mode)
-        hv.save(_plot, file_name)
+    def same_coordinates(self):
+        # appended points can move the dataset into another UTM zone, the old distances are then stale
+        # projected_crs is only set once the points are projected
+        base, points = self.traj_collection.base.points, self.traj_collection.points
+        base.projected, points.projected
+        return base.projected_crs == points.projected_crs
@@ -1,28 +1,128 @@
+import copy
 import glob
+import hashlib
+import json
 import os
 import geopandas as gpd
-import holoviews as hv
 import movingpandas as mpd
+import numpy as np
 import pandas as pd
 import pickle
+import re
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
-from urllib.request import urlretrieve
+from pyproj import Transformer
 
-from src.utils import contains_gpx_data
+from src.cache import cache_key, file_digest, touch
+from src.cleaning import CleaningEngine
+from src.instrumentation import count, log, span
+from src.download import Downloader
+from src.rendering import RasterPlot, render
+
+
+def _page_number(file_name):
+    return int(re.search(r"tracks\((\d+)\)\.gpx$", file_name).group(1))
+
+
+def _read_track_points(file_name):
+    return gpd.read_file(file_name, layer="track_points", columns=OSMTraces.RAW_COLUMNS)
+
+
+class PointTable:
+    def __init__(self, trajectories):
+        dfs = [traj.df for traj in trajectories]
+        df = pd.concat(dfs)
+        self.tz = df.index.tz
+        self.xy = np.column_stack([df.geometry.x, df.geometry.y])
+        self.time = df.index.to_numpy() if self.tz is None else df.index.tz_convert(None).to_numpy()
+        self.track_fid = df["track_fid"].to_numpy()
+        self.track_seg_id = df["track_seg_id"].to_numpy()
+        self.track_seg_point_id = df["track_seg_point_id"].to_numpy()
+        self.traj_id = np.repeat(np.arange(len(dfs)), [len(df) for df in dfs])
+        for array in (self.xy, self.time, self.track_fid, self.track_seg_id, self.track_seg_point_id, self.traj_id):
+            array.setflags(write=False)
+        self._geometry = None
+        self._fingerprint = None
+        self._projected = None
+        self.projected_crs = None
+
+    def __len__(self):
+        return len(self.xy)
+
+    @property
+    def lon(self):
+        return self.xy[:, 0]
+
+    @property
+    def lat(self):
+        return self.xy[:, 1]
+
+    @property
+    def fingerprint(self):
+        # identifies the dataset that results were computed on, stored next to every result
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            for array in (self.xy, self.time, self.traj_id):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    @property
+    def projected(self):
+        # xy in metres in the local UTM zone, projected once and shared by metric clustering and scoring
+        if self._projected is None:
+            self.projected_crs = gpd.GeoSeries(self.geometry).estimate_utm_crs()
+            transformer = Transformer.from_crs("epsg:4326", self.projected_crs, always_xy=True)
+            self._projected = np.column_stack(transformer.transform(self.lon, self.lat))
+            self._projected.setflags(write=False)
+        return self._projected
+
+    @property
+    def geometry(self):
+        if self._geometry is None:
+            self._geometry = gpd.points_from_xy(self.lon, self.lat, crs="epsg:4326")
+        return self._geometry
+
+    def to_gdf(self, labels):
+        time = pd.DatetimeIndex(self.time)
+        return gpd.GeoDataFrame({
+            "time": time if self.tz is None else time.tz_localize("UTC").tz_convert(self.tz),
+            "track_fid": self.track_fid,
+            "track_seg_id": self.track_seg_id,
+            "track_seg_point_id": self.track_seg_point_id,
+            "geometry": self.geometry,
+            "label": labels,
+        }, geometry="geometry", crs="epsg:4326")
 
 
 class OSMTraces:
     API_URL = "https://api.openstreetmap.org/api/0.6/trackpoints"
+    TOLERANCE = 0.0001
+    GAP = timedelta(minutes=30)
+    MIN_POINTS = 10
+    RAW_COLUMNS = ["track_fid", "track_seg_id", "track_seg_point_id", "time"]
+    PAGES_FOLDER = "pages"
+    MAX_STATES = 5
+    # cached datasets and cleaned pages, evicted together with the solutions (Evaluation)
+    CACHE_PATTERNS = ("osm_traces_*.pkl", os.path.join(PAGES_FOLDER, "page_*.pkl"))
 
-    def __init__(self, root, bbox, download=False):
+    def __init__(self, root, bbox, download=False, transport=None, max_pages=10, incremental=False):
         self.root = root
         self.bbox = bbox
+        self.transport = transport
+        self.max_pages = max_pages
+        self.incremental = incremental
         self.raw = gpd.GeoDataFrame()
         self.data = mpd.TrajectoryCollection([])
+        # the previously ingested dataset when this one only appends trajectories to it, so
+        # solutions can be updated from its results instead of recomputed (see Solution.load_previous)
+        self.base = None
+        self._points = None
+        self._cache_file_name = None
 
         if download:
-            self.download()
+            self.download(refresh=incremental)
 
         self.load()
 
@@ -30,95 +130,209 @@ class OSMTraces:
     def trajectories(self):
         return self.data.trajectories
 
+    @property
+    def points(self):
+        if self._points is None:
+            self._points = PointTable(self.trajectories)
+        return self._points
+
+    @property
+    def cache_file_name(self):
+        # keyed on the raw GPX content and the cleaning parameters, so new pages or a
+        # different tolerance/gap never reuse a stale dataset
+        if self._cache_file_name is None:
+            pages = sorted(glob.glob(os.path.join(self.root, "tracks(*).gpx")))
+            key = cache_key(
+                [(os.path.basename(page), file_digest(page)) for page in pages],
+                self.TOLERANCE, self.GAP, self.MIN_POINTS
+            )
+            self._cache_file_name = f"osm_traces_{key}.pkl"
+        return self._cache_file_name
+
+    @property
+    def manifest_file_name(self):
+        return f"osm_traces_{cache_key(self.TOLERANCE, self.GAP, self.MIN_POINTS)}.json"
+
     def _check_exists(self, file_name=""):
         return os.path.exists(os.path.join(self.root, file_name))
 
-    def download(self):
-        if self._check_exists():
-            return
+    def subset(self, fraction, random_state=0):
+        # a fixed permutation per random_state, so smaller subsets are nested in larger ones
+        order = np.random.default_rng(random_state).permutation(len(self.trajectories))
+        keep = np.sort(order[:max(1, round(len(order) * fraction))])
+        subset = copy.copy(self)
+        subset.data = mpd.TrajectoryCollection([self.trajectories[i] for i in keep])
+        subset.base = None
+        subset._points = None
+        return subset
 
-        os.makedirs(self.root)
-        print("DOWNLOADING...")
-        page = 0
+    def download(self, refresh=False):
         bbox = ",".join([str(b) for b in self.bbox])
-        print(bbox)
-        while True:
-            file_name = os.path.join(self.root, f"tracks({page}).gpx")
-            url = f"{self.API_URL}?bbox={bbox}&page={page}"
-            print(url)
-            urlretrieve(url, file_name)
-            if not contains_gpx_data(file_name):
-                os.remove(file_name)
-                break
-            page += 1
-            if page == 10:
-                break
+        Downloader(self.root, f"{self.API_URL}?bbox={bbox}", self.transport, self.max_pages).run(refresh)
 
-    def load_raw_data(self):
-        self.raw = gpd.GeoDataFrame(
-            columns=["track_fid", "track_seg_id", "track_seg_point_id", "time", "geometry"],
-            geometry="geometry"
-        )
+    def load_raw_data(self, max_workers=None):
         search_pattern = os.path.join(self.root, "tracks(*).gpx")
-        for file_name in glob.glob(search_pattern):
-            init = 0 if len(self.raw.index) == 0 else self.raw["track_fid"].unique()[-1] + 1,
-            new_data = gpd.read_file(file_name, layer="track_points")
-            new_data.drop(columns=["ele", "course", "speed", "magvar", "geoidheight", "name", "cmt", "desc",
-                                   "src", "url", "urlname", "sym", "type", "fix", "sat", "hdop", "vdop",
-                                   "pdop", "ageofdgpsdata", "dgpsid"], inplace=True)
-            new_data["track_fid"] += init
-            new_data = new_data.groupby("track_fid")
-            new_data = new_data.apply(lambda group: group.sort_values(by="time"))
-            new_data = new_data.reset_index(drop=True)
-            self.raw = pd.concat([self.raw, new_data])
+        pages = sorted(glob.glob(search_pattern), key=_page_number)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            frames = list(executor.map(_read_track_points, pages))
+
+        offset = 0
+        for frame in frames:
+            # track_fid restarts at 0 in every page
+            frame["track_fid"] += offset
+            if len(frame.index) > 0:
+                offset = frame["track_fid"].max() + 1
+        if not frames:
+            # an area without trackpoints, the API's first page was already empty
+            frames = [gpd.GeoDataFrame({
+                "track_fid": pd.Series(dtype="int32"), "track_seg_id": pd.Series(dtype="int32"),
+                "track_seg_point_id": pd.Series(dtype="int32"), "time": pd.Series(dtype="datetime64[ms, UTC]"),
+            }, geometry=gpd.GeoSeries([]), crs="EPSG:4326")]
+        raw = pd.concat(frames, ignore_index=True)
+        self.raw = raw.sort_values(["track_fid", "time"], kind="stable", ignore_index=True)
+        count("raw_points", len(self.raw))
 
     def load(self):
-        print("LOADING DATA...")
-        if self._check_exists("osm_traces.pkl"):
-            with open(os.path.join(self.root, "osm_traces.pkl"), "rb") as f:
-                self.data = pickle.load(f)
-            return
+        log("LOADING DATA...")
+        with span("load", incremental=self.incremental):
+            if self.incremental:
+                self.load_incremental()
+                return
+            if self._check_exists(self.cache_file_name):
+                count("dataset_cache_hits")
+                touch(os.path.join(self.root, self.cache_file_name))
+                with open(os.path.join(self.root, self.cache_file_name), "rb") as f:
+                    self.data = pickle.load(f)
+                    self._points = None
+                return
 
-        self.load_raw_data()
-        self.data = mpd.TrajectoryCollection(self.raw, "track_fid", t="time")
-        # print(f"LOADED {len(self.data)} TRAJECTORIES")
-        self.data.add_distance(overwrite=True, units="m")
-        # self.data.add_timedelta(overwrite=True)
-        self.data.add_speed(name="speed", overwrite=True, units=("km", "h"))
-        self.clean()
+            count("dataset_cache_misses")
+            with span("read_pages"):
+                self.load_raw_data()
+            self.clean()
+
+    @property
+    def cleaner(self):
+        return CleaningEngine(self.TOLERANCE, self.GAP, self.MIN_POINTS)
 
     def clean(self):
-        if self._check_exists("osm_traces.pkl"):
+        if self._check_exists(self.cache_file_name):
             return
 
-        print("CLEANING DATA...")
-        self.data = mpd.DouglasPeuckerGeneralizer(self.data).generalize(tolerance=0.0001) #tolerance=0.0001 thuật toán được phép loại bỏ các điểm dữ liệu nhỏ hơn ngưỡng này
-        new_data = []
-        for i, track in enumerate(self.trajectories):
-            for j, traj in enumerate(mpd.ObservationGapSplitter(track).split(gap=timedelta(minutes=30)).trajectories): #chia trajectory thành các phần nhỏ hơn nếu gap > 30 phút
-                if len(traj.df.index) < 10: # nếu trajectory con ít hơn 10 điểm thì bỏ qua
-                    continue
-                new_data.append(traj)
-        self.data = mpd.TrajectoryCollection(new_data)
+        log("CLEANING DATA...")
+        with span("clean", raw_points=len(self.raw)):
+            self.data = mpd.TrajectoryCollection(self.cleaner.clean(self.raw))
+        count("points", sum(len(traj.df.index) for traj in self.trajectories))
+        self._points = None
         self.save()
 
+    def load_page(self, page, offset):
+        # one page cleaned on its own: track_fid restarts in every page, so no track spans two
+        # pages and the result is the same as cleaning all pages together
+        key = cache_key(file_digest(page), offset, self.TOLERANCE, self.GAP, self.MIN_POINTS)
+        file_name = os.path.join(self.root, self.PAGES_FOLDER, f"page_{key}.pkl")
+        if os.path.exists(file_name):
+            count("page_cache_hits")
+            touch(file_name)
+            with open(file_name, "rb") as f:
+                return key, pickle.load(f)
+
+        count("page_cache_misses")
+        log(f"CLEANING {os.path.basename(page)}...")
+        with span("read_pages", page=os.path.basename(page)):
+            frame = _read_track_points(page)
+        count("raw_points", len(frame.index))
+        tracks = int(frame["track_fid"].max()) + 1 if len(frame.index) > 0 else 0
+        frame["track_fid"] += offset
+        with span("clean", raw_points=len(frame.index)):
+            cleaned = {"tracks": tracks, "trajectories": self.cleaner.clean(frame)}
+        count("points", sum(len(traj.df.index) for traj in cleaned["trajectories"]))
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(f"{file_name}.tmp", "wb") as f:
+            pickle.dump(cleaned, f)
+        os.replace(f"{file_name}.tmp", file_name)
+        return key, cleaned
+
+    def load_incremental(self):
+        # pages are cleaned and stored one by one, so new or changed pages are the only ones
+        # parsed and cleaned again. A page is keyed on its content and its track_fid offset,
+        # which only moves when an earlier page changes
+        manifest_path = os.path.join(self.root, self.manifest_file_name)
+        states = []
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                states = json.load(f)["states"]
+
+        pages = sorted(glob.glob(os.path.join(self.root, "tracks(*).gpx")), key=_page_number)
+        state, trajectories, offset = [], [], 0
+        for page in pages:
+            key, cleaned = self.load_page(page, offset)
+            state.append([key, len(cleaned["trajectories"])])
+            trajectories.extend(cleaned["trajectories"])
+            offset += cleaned["tracks"]
+        self.data = mpd.TrajectoryCollection(trajectories)
+        self._points = None
+
+        # the latest earlier state whose trajectories still start the dataset, followed by new ones
+        self.base = None
+        for previous in reversed(states):
+            size = self.base_size(previous, state, trajectories)
+            if size is not None:
+                self.base = copy.copy(self)
+                self.base.data = mpd.TrajectoryCollection(trajectories[:size])
+                self.base._points = None
+                self.base.base = None
+                log(f"APPENDED {len(trajectories) - len(self.base.trajectories)} TRAJECTORIES")
+                break
+
+        if state not in states:
+            states = (states + [state])[-self.MAX_STATES:]
+            with open(f"{manifest_path}.tmp", "w") as f:
+                json.dump({"states": states}, f)
+            os.replace(f"{manifest_path}.tmp", manifest_path)
+
+    def base_size(self, previous, state, trajectories):
+        # trajectories of an earlier state when they start the current dataset unchanged and more
+        # follow: its pages are unchanged and new pages follow, or its last page grew (a refresh
+        # fetches the short last page again) and the trajectories cleaned from the old version of
+        # that page, still in the page cache, come first in the new one. None otherwise
+        if not previous or len(previous) > len(state) or state[:len(previous) - 1] != previous[:-1]:
+            return None
+        size = sum(n for _, n in previous)
+        if size >= len(trajectories):
+            return None
+        if state[len(previous) - 1] == previous[-1]:
+            return size
+        file_name = os.path.join(self.root, self.PAGES_FOLDER, f"page_{previous[-1][0]}.pkl")
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name, "rb") as f:
+            old = pickle.load(f)["trajectories"]
+        current = trajectories[size - len(old):size]
+        if all(a.id == b.id and a.df.equals(b.df) for a, b in zip(old, current)):
+            log(f"PAGE {len(previous) - 1} GREW")
+            return size
+        return None
+
     def get_data_as_points(self):
         for traj_id, traj in enumerate(self.trajectories):
-            timestamps = traj.to_point_gdf().index
-            data = traj.to_point_gdf().values
+            point_gdf = traj.to_point_gdf()
+            timestamps = point_gdf.index
+            data = point_gdf.values
             yield from [(t, *d[:-2]) for t, d in zip(timestamps, data)]
 
     def save(self):
-        if not self._check_exists("osm_traces.pkl"):
-            print("SAVING DATA...")
-            with open(os.path.join(self.root, "osm_traces.pkl"), "wb") as f: #ghi dữ liệu nhị phân
+        if not self._check_exists(self.cache_file_name):
+            log("SAVING DATA...")
+            with open(os.path.join(self.root, self.cache_file_name), "wb") as f: #ghi dữ liệu nhị phân
                 pickle.dump(self.data, f)
 
-    def plot(self, file_name):
-        print(f"PLOTTING {len(self.data)} TRAJECTORIES...")
-        plots = []
-        for traj in self.data.trajectories:
-            plots.append(traj.hvplot(
-                c="speed", line_width=2, cmap="plasma", clabel="Speed", tiles="CartoLight" if len(plots) == 0 else None
-            ))
-        hv.save(hv.Overlay(plots), file_name)
+    def plot(self, file_name, renderer=None):
+        log(f"PLOTTING {len(self.data)} TRAJECTORIES...")
+        if renderer is not None and renderer.raster:
+            speed = np.concatenate([traj.df["speed"].to_numpy() for traj in self.data.trajectories])
+            _plot = RasterPlot(self.points.xy, speed, "trajectories", "Speed", groups=self.points.traj_id)
+        else:
+            # one layer for the whole collection instead of one per trajectory
+            _plot = self.data.hvplot(c="speed", line_width=2, cmap="plasma", clabel="Speed", tiles="CartoLight")
+        render(_plot, file_name, renderer)
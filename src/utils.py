@@ -1,16 +1,172 @@
+import geopandas as gpd
+import numpy as np
+import shapely
+
+from shapely import STRtree
 from xml.etree import ElementTree
 
 
-def contains_gpx_data(file_path):
-    NSMAP = {"gpx": "http://www.topografix.com/GPX/1/0"}
+def gpx_point_count(file_path):
+    # trackpoints in a GPX page, 0 for an empty or unreadable document
+    points = 0
     try:
-        tree = ElementTree.parse(file_path)
-        root = tree.getroot()
-        return bool(root.find(".//gpx:trk", namespaces=NSMAP))
+        for _, element in ElementTree.iterparse(file_path):
+            if element.tag == "{http://www.topografix.com/GPX/1/0}trkpt":
+                points += 1
+            element.clear()
     except ElementTree.ParseError:
-        return False
+        return 0
+    return points
+
+
+class FlowIndex:
+    def __init__(self, flows):
+        self.weights = flows["weight"].to_numpy()
+        self.tree = STRtree(np.asarray(flows.geometry.values))
+
+    def nearest(self, points, max_distance=None):
+        points = np.asarray(points)
+        nearest = np.full(len(points), len(self.weights))
+        if len(self.weights) > 0:
+            input_idx, tree_idx = self.tree.query_nearest(points, max_distance=max_distance, all_matches=True)
+            # equidistant flows resolve to the lowest index, as idxmin over the distances did
+            np.minimum.at(nearest, input_idx, tree_idx)
+        nearest[nearest == len(self.weights)] = -1
+        return nearest
+
+    def query(self, points, max_distance=None):
+        return self.weights_of(self.nearest(points, max_distance))
+
+    def weights_of(self, nearest):
+        # weight of every nearest flow, -1 where a point has none
+        labels = np.full(len(nearest), -1, dtype=self.weights.dtype)
+        labels[nearest >= 0] = self.weights[nearest[nearest >= 0]]
+        return labels
+
+
+def segment_distance(xy, start, end):
+    # point to segment distance computed as GEOS does, so near-ties resolve the same way
+    d = end - start
+    length2 = d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1]
+    to_start = np.sqrt((xy[:, 0] - start[:, 0]) ** 2 + (xy[:, 1] - start[:, 1]) ** 2)
+    to_end = np.sqrt((xy[:, 0] - end[:, 0]) ** 2 + (xy[:, 1] - end[:, 1]) ** 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = ((xy[:, 0] - start[:, 0]) * d[:, 0] + (xy[:, 1] - start[:, 1]) * d[:, 1]) / length2
+        s = ((start[:, 1] - xy[:, 1]) * d[:, 0] - (start[:, 0] - xy[:, 0]) * d[:, 1]) / length2
+    distance = np.where(r >= 1, to_end, np.abs(s) * np.sqrt(length2))
+    return np.where((length2 == 0) | (r <= 0), to_start, distance)
+
+
+class FlowGrid:
+    # FlowIndex.nearest for many small batches of points: a regular grid over the flows keeps, for
+    # every cell, the flow segments that can be nearest to some point of the cell. A point is within
+    # h (half the cell diagonal) of its cell centre c, so its nearest flow is within best + 2h of c,
+    # best being the distance from c to the flow nearest to c. A query is then a few vectorised
+    # point-segment distances per point; points outside the grid go to the FlowIndex
+    def __init__(self, flow_index, segments, segment_flow, origin, cell, shape, offsets, candidates):
+        self.flow_index = flow_index
+        self.segments = segments
+        self.segment_flow = segment_flow
+        self.origin = origin
+        self.cell = cell
+        self.shape = shape
+        self.offsets = offsets
+        self.candidates = candidates
+
+    @classmethod
+    def build(cls, flows, cells=64):
+        flow_index = FlowIndex(flows)
+        coords, index = shapely.get_coordinates(flows.geometry.values, return_index=True)
+        same = index[1:] == index[:-1]
+        segments = np.column_stack([coords[:-1][same], coords[1:][same]])
+        segment_flow = index[1:][same]
+        if len(segments) == 0:
+            return cls(flow_index, segments.reshape(0, 4), segment_flow, np.zeros(2), 1.0, np.zeros(2, dtype=int),
+                       np.zeros(1, dtype=int), np.zeros(0, dtype=int))
+
+        x0, y0, x1, y1 = shapely.total_bounds(flows.geometry.values)
+        cell = max(x1 - x0, y1 - y0) / cells or 1e-9
+        shape = np.maximum(1, np.ceil(np.array([x1 - x0, y1 - y0]) / cell).astype(int))
+        i, j = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing="ij")
+        centres = shapely.points(x0 + (i.ravel() + 0.5) * cell, y0 + (j.ravel() + 0.5) * cell)
+        tree = STRtree(shapely.linestrings(segments.reshape(-1, 2, 2)))
+        _, best = tree.query_nearest(centres, return_distance=True, all_matches=False)
+        reach = best + cell * np.sqrt(2) * (1 + 1e-9)
+        centre, candidate = tree.query(centres, predicate="dwithin", distance=reach)
+        order = np.lexsort((candidate, centre))
+        offsets = np.searchsorted(centre[order], np.arange(len(centres) + 1))
+        return cls(flow_index, segments, segment_flow, np.array([x0, y0]), cell, shape, offsets, candidate[order])
+
+    def nearest(self, xy, max_distance=None):
+        xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+        nearest = np.full(len(xy), -1)
+        if len(self.segments) == 0:
+            return nearest
+        cell = np.floor((xy - self.origin) / self.cell).astype(int)
+        inside = np.all((cell >= 0) & (cell < self.shape), axis=1)
+        outside = np.flatnonzero(~inside)
+        if len(outside) > 0:
+            nearest[outside] = self.flow_index.nearest(shapely.points(xy[outside]), max_distance)
+
+        # one row per point and candidate segment of its cell
+        points = np.flatnonzero(inside)
+        cells = cell[points, 0] * self.shape[1] + cell[points, 1]
+        starts, counts = self.offsets[cells], np.diff(self.offsets)[cells]
+        point = np.repeat(points, counts)
+        segment = self.candidates[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts - starts, counts)]
+        distance = segment_distance(xy[point], self.segments[segment, :2], self.segments[segment, 2:])
+        if max_distance is not None:
+            distance[distance > max_distance] = np.inf
+        if len(points) == 0:
+            return nearest
+        # every cell has a candidate, so each point is one non-empty run of rows; equidistant flows
+        # resolve to the lowest index
+        runs = np.cumsum(counts) - counts
+        closest = np.minimum.reduceat(distance, runs)
+        flow = np.where(distance == np.repeat(closest, counts), self.segment_flow[segment], len(self.flow_index.weights))
+        flow = np.minimum.reduceat(flow, runs)
+        nearest[points] = np.where(np.isinf(closest), -1, flow)
+        return nearest
+
+    def to_arrays(self, name):
+        return {
+            f"{name}_segments": self.segments, f"{name}_segment_flow": self.segment_flow,
+            f"{name}_origin": self.origin, f"{name}_cell": np.array(self.cell), f"{name}_shape": self.shape,
+            f"{name}_offsets": self.offsets, f"{name}_candidates": self.candidates,
+        }
+
+    @classmethod
+    def from_arrays(cls, name, arrays, flows):
+        return cls(
+            FlowIndex(flows), arrays[f"{name}_segments"], arrays[f"{name}_segment_flow"], arrays[f"{name}_origin"],
+            float(arrays[f"{name}_cell"]), arrays[f"{name}_shape"], arrays[f"{name}_offsets"],
+            arrays[f"{name}_candidates"],
+        )
+
+
+def frame_to_arrays(name, gdf):
+    # flat numpy arrays for np.savez, so results can be stored without pickling geometries
+    coords, index = shapely.get_coordinates(gdf.geometry.values, return_index=True)
+    columns = [column for column in gdf.columns if column != gdf.geometry.name]
+    arrays = {
+        f"{name}_coords": coords,
+        f"{name}_index": index,
+        f"{name}_type": shapely.get_type_id(gdf.geometry.values),
+        f"{name}_columns": np.array(columns, dtype=str),
+        f"{name}_crs": np.array(gdf.crs.to_string() if gdf.crs is not None else ""),
+    }
+    for column in columns:
+        arrays[f"{name}_{column}"] = gdf[column].to_numpy()
+    return arrays
 
 
-def find_closest_segment(gdf, point):
-    distances = gdf["geometry"].apply(lambda flow: flow.distance(point))
-    return gdf.at[distances.idxmin(), "weight"]
+def frame_from_arrays(name, arrays):
+    coords, index, types = arrays[f"{name}_coords"], arrays[f"{name}_index"], arrays[f"{name}_type"]
+    if np.all(types == shapely.GeometryType.POINT):
+        geometry = shapely.points(coords)
+    elif np.all(types == shapely.GeometryType.LINESTRING):
+        geometry = shapely.linestrings(coords, indices=index)
+    else:
+        raise ValueError(f"Cannot restore {name}: only point and linestring frames are supported")
+    data = {str(column): arrays[f"{name}_{column}"] for column in arrays[f"{name}_columns"]}
+    return gpd.GeoDataFrame(data, geometry=geometry, crs=str(arrays[f"{name}_crs"]) or None)
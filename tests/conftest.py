@@ -0,0 +1,44 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import SyntheticTraces  # noqa: E402
+from src.aggregation import TcaEngine  # noqa: E402
+from src.instrumentation import configure  # noqa: E402
+from src.traces import OSMTraces  # noqa: E402
+
+configure(quiet=True)
+
+
+class Points:
+    # the part of PointTable that Dbscan reads, for clustering plain arrays
+    def __init__(self, xy):
+        self.xy = xy
+        self.fingerprint = hashlib.sha1(np.ascontiguousarray(xy).tobytes()).hexdigest()
+
+
+class Collection:
+    def __init__(self, xy, base=None):
+        self.points = Points(xy)
+        self.base = base
+
+
+@pytest.fixture(scope="session")
+def traces(tmp_path_factory):
+    # a few thousand cleaned points of synthetic road traffic, read through the normal pipeline
+    root = tmp_path_factory.mktemp("traces")
+    bbox = SyntheticTraces(20000, seed=3).write(str(root))
+    return OSMTraces(str(root), bbox)
+
+
+@pytest.fixture(scope="session")
+def flows(traces):
+    # TCA flows of the traces before reverse flows are merged
+    return TcaEngine(traces.data).aggregator(100, 200, timedelta(minutes=10)).get_flows_gdf()
@@ -0,0 +1,28 @@
+import movingpandas as mpd
+import numpy as np
+import pytest
+import shapely
+
+from datetime import timedelta
+
+from src.aggregation import TESTED_MOVINGPANDAS, TcaEngine
+
+
+@pytest.mark.skipif(
+    not mpd.__version__.startswith(f"{TESTED_MOVINGPANDAS}."), reason="the engine falls back to movingpandas"
+)
+def test_engine_matches_movingpandas_aggregator(traces):
+    engine = TcaEngine(traces.data)
+    # one engine across the cells, as in a grid search, so the memoised distances are reused
+    for min_distance, max_distance in [(50, 100), (100, 200), (150, 400)]:
+        expected = mpd.TrajectoryCollectionAggregator(
+            traces.data, max_distance, min_distance, timedelta(minutes=10)
+        )
+        actual = engine.aggregator(min_distance, max_distance, timedelta(minutes=10))
+        for name in ("get_significant_points_gdf", "get_clusters_gdf", "get_flows_gdf"):
+            a, b = getattr(actual, name)(), getattr(expected, name)()
+            assert list(a.columns) == list(b.columns)
+            assert len(a) == len(b) > 0
+            assert shapely.equals(a.geometry.values, b.geometry.values).all()
+            for column in a.columns.drop(a.geometry.name):
+                np.testing.assert_array_equal(a[column].to_numpy(), b[column].to_numpy())
@@ -0,0 +1,70 @@
+import os
+
+import geopandas as gpd
+import numpy as np
+
+from src.batch import BatchRunner, Tile
+from src.download import Downloader
+from src.pipeline import bbox_folder, run_bbox, save_summary, split_track_ids
+
+
+def test_empty_tile_stitches_to_nothing(tmp_path):
+    tile = Tile((0.0, 0.0, 0.001, 0.001), 0)
+    roots = {name: str(tmp_path / name) for name in ("data", "results", "images")}
+    # a finished download that found no pages
+    os.makedirs(os.path.join(roots["data"], bbox_folder(tile.bbox)))
+    open(os.path.join(roots["data"], bbox_folder(tile.bbox), Downloader.COMPLETE_FILE_NAME), "w").close()
+
+    summary = run_bbox(tile.bbox, data_root=roots["data"], results_root=roots["results"], images_root=roots["images"])
+    with np.load(summary) as f:
+        assert len(f["points_coords"]) == len(f["flows_coords"]) == len(f["clusters_coords"]) == 0
+
+    runner = BatchRunner(str(tmp_path), [tile])
+    runner.mark(tile, "done", summary=summary)
+    stitched = runner.stitch()
+    assert {name: len(gdf) for name, gdf in stitched.items()} == {"flows": 0, "clusters": 0, "points": 0}
+
+
+def test_stitch_merges_dbscan_clusters_across_tiles(tmp_path):
+    west, east = Tile((0.0, 0.0, 1.0, 1.0), 0.2), Tile((1.0, 0.0, 2.0, 1.0), 0.2)
+    runner = BatchRunner(str(tmp_path), [west, east])
+    empty = {"geometry": gpd.GeoSeries([]), "crs": "EPSG:4326"}
+    flows = gpd.GeoDataFrame({"weight": np.zeros(0), "obj_weight": np.zeros(0)}, **empty)
+    clusters = gpd.GeoDataFrame({"n": np.zeros(0, int)}, **empty)
+    # a cluster straddling x = 1 is seen by both tiles in the overlap, each with its own id;
+    # the east tile also has a cluster of its own and a noise point
+    tiles = {
+        west: ([0.5, 0.9, 0.95, 1.05, 1.1], [0, 1, 1, 1, 1]),
+        east: ([0.9, 0.95, 1.05, 1.1, 1.15, 1.5, 1.6, 1.7], [0, 0, 0, 0, 0, 1, 1, -1]),
+    }
+    for i, (tile, (x, cluster)) in enumerate(tiles.items()):
+        points = gpd.GeoDataFrame({
+            "track_fid": np.arange(len(x), dtype=np.int64), "label": np.zeros(len(x), int), "cluster": np.array(cluster),
+        }, geometry=gpd.points_from_xy(x, np.full(len(x), 0.5)), crs="EPSG:4326")
+        summary = save_summary(str(tmp_path / f"summary_{i}.npz"), [], [], flows, clusters, points)
+        runner.mark(tile, "done", summary=summary)
+
+    points = runner.stitch()["points"]
+    assert points.geometry.x.tolist() == [0.5, 0.9, 0.95, 1.05, 1.1, 1.15, 1.5, 1.6, 1.7]
+    merged, own, noise = points["cluster"].iloc[1], points["cluster"].iloc[6], points["cluster"].iloc[8]
+    assert points["cluster"].tolist() == [points["cluster"].iloc[0]] + [merged] * 5 + [own] * 2 + [-1]
+    assert len({points["cluster"].iloc[0], merged, own}) == 3 and noise == -1
+    assert points["label"].tolist() == [1, 5, 5, 5, 5, 5, 2, 2, -1]
+    with np.load(tmp_path / BatchRunner.STITCHED_FILE_NAME) as f:
+        assert str(f["note"]) == BatchRunner.NOTE
+
+
+def test_split_track_ids(traces):
+    assert [a.tolist() for a in split_track_ids(["5_0", "12_3", "1_23"])] == [[5, 12, 1], [0, 3, 23]]
+    # every cleaned trajectory comes back as its own (track_fid, segment) pair
+    ids = [traj.id for traj in traces.trajectories]
+    fid, segment = split_track_ids(ids)
+    assert len(set(zip(fid, segment))) == len(ids)
+    assert [f"{f}_{s}" for f, s in zip(fid, segment)] == ids
+
+
+def test_memory_budget_is_split_over_the_tile_processes(tmp_path):
+    tile = Tile((0.0, 0.0, 1.0, 1.0), 0)
+    assert BatchRunner(str(tmp_path), [tile], n_jobs=3, memory_bytes=8 << 30).process_memory_bytes == 2 << 30
+    assert BatchRunner(str(tmp_path), [tile], n_jobs=1, memory_bytes=8 << 30).process_memory_bytes == 8 << 30
+    assert BatchRunner(str(tmp_path), [tile], n_jobs=3).process_memory_bytes is None
@@ -0,0 +1,44 @@
+import movingpandas as mpd
+import numpy as np
+import pytest
+
+from src.cleaning import CleaningEngine
+from src.traces import OSMTraces
+
+
+def movingpandas_clean(raw):
+    # the chain CleaningEngine replaces
+    data = mpd.TrajectoryCollection(raw, "track_fid", t="time")
+    data.add_distance(overwrite=True, units="m")
+    data.add_speed(name="speed", overwrite=True, units=("km", "h"))
+    data = mpd.DouglasPeuckerGeneralizer(data).generalize(tolerance=OSMTraces.TOLERANCE)
+    return [
+        traj
+        for track in data.trajectories
+        for traj in mpd.ObservationGapSplitter(track).split(gap=OSMTraces.GAP).trajectories
+        if len(traj.df.index) >= OSMTraces.MIN_POINTS
+    ]
+
+
+@pytest.mark.parametrize("repeat_times", [False, True])
+def test_engine_matches_movingpandas_chain(traces, repeat_times):
+    traces.load_raw_data()
+    raw = traces.raw.copy()
+    if repeat_times:
+        # a repeated timestamp within a track, which Trajectory drops
+        rows = np.arange(1, len(raw), 37)
+        rows = rows[raw["track_fid"].to_numpy()[rows] == raw["track_fid"].to_numpy()[rows - 1]]
+        raw.loc[rows, "time"] = raw["time"].to_numpy()[rows - 1]
+
+    expected = movingpandas_clean(raw)
+    actual = CleaningEngine(OSMTraces.TOLERANCE, OSMTraces.GAP, OSMTraces.MIN_POINTS).clean(raw)
+    assert len(expected) > 0
+    assert [traj.id for traj in actual] == [traj.id for traj in expected]
+    for a, b in zip(actual, expected):
+        a, b = a.df, b.df
+        assert a.index.equals(b.index)
+        assert a.geometry.geom_equals(b.geometry).all()
+        for column in ("track_fid", "track_seg_id", "track_seg_point_id"):
+            np.testing.assert_array_equal(a[column].to_numpy(), b[column].to_numpy())
+        for column in ("distance", "speed"):
+            np.testing.assert_allclose(a[column].to_numpy(), b[column].to_numpy(), rtol=1e-9, atol=1e-9)
@@ -0,0 +1,82 @@
+import shutil
+
+import numpy as np
+import pytest
+
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import NearestNeighbors
+
+from benchmarks.synthetic import SyntheticTraces
+from src.instrumentation import configure, recorder
+from src.solutions import Dbscan, MetricDbscan
+from src.traces import OSMTraces
+from tests.conftest import Collection
+
+
+@pytest.mark.parametrize("solution_class, grid", [
+    (Dbscan, [(0.0002, 5), (0.0003, 5), (0.0006, 10)]),
+    (MetricDbscan, [(20.0, 5), (30.0, 5), (60.0, 10)]),
+])
+def test_shared_neighbours_graph_matches_per_cell_fit(tmp_path, traces, solution_class, grid):
+    shared = solution_class.shared_state(traces, grid)
+    # separate roots, the stored solution is keyed on the parameters only
+    (tmp_path / "fit").mkdir()
+    (tmp_path / "shared").mkdir()
+    for eps, min_samples in grid:
+        expected = solution_class(str(tmp_path / "fit"), traces, eps, min_samples)
+        actual = solution_class(str(tmp_path / "shared"), traces, eps, min_samples, **shared)
+        np.testing.assert_array_equal(actual.labels_, expected.labels_)
+
+
+def assert_same_clustering(xy, eps, min_samples, clusters, core):
+    # DBSCAN is unique up to the cluster of a border point reached by several clusters
+    db = DBSCAN(eps=eps, min_samples=min_samples).fit(xy)
+    expected_core = np.zeros(len(xy), dtype=bool)
+    expected_core[db.core_sample_indices_] = True
+    np.testing.assert_array_equal(core, expected_core)
+    np.testing.assert_array_equal(clusters == -1, db.labels_ == -1)
+    pairs = set(zip(clusters[core], db.labels_[core]))
+    assert len(pairs) == len({a for a, _ in pairs}) == len({b for _, b in pairs})
+    neighbors = NearestNeighbors(radius=eps).fit(xy).radius_neighbors(xy, return_distance=False)
+    for i in np.flatnonzero(~core & (clusters >= 0)):
+        assert np.any(core[neighbors[i]] & (clusters[neighbors[i]] == clusters[i]))
+
+
+@pytest.mark.parametrize("seed", [None, 0, 1, 2, 3])
+def test_update_matches_full_fit(tmp_path, seed):
+    if seed is None:
+        # an all-noise solution that the appended points do not change
+        xy = np.column_stack([np.arange(12.0), np.zeros(12)])
+        n_old, eps, min_samples = 8, 0.5, 3
+    else:
+        rng = np.random.default_rng(seed)
+        centres = rng.uniform(0, 10, (6, 2))
+        xy = np.concatenate([centres[rng.integers(0, 6, 300)] + rng.normal(0, 0.4, (300, 2)), rng.uniform(0, 10, (60, 2))])
+        xy = xy[rng.permutation(len(xy))]
+        n_old, eps, min_samples = int(rng.integers(0, 300)), 0.3, 5
+    base = Collection(xy[:n_old])
+    Dbscan(str(tmp_path), base, eps, min_samples)
+    updated = Dbscan(str(tmp_path), Collection(xy, base=base), eps, min_samples)
+    stored = updated.load()
+    assert_same_clustering(xy, eps, min_samples, stored["clusters"], stored["core"])
+
+
+def test_metric_update_on_appended_page(tmp_path):
+    # an incremental OSMTraces whose second page arrives later, as the pipeline loads it
+    bbox = SyntheticTraces(8000, seed=5).write(str(tmp_path / "pages"))
+    (tmp_path / "data").mkdir()
+    (tmp_path / "results").mkdir()
+    shutil.copy(tmp_path / "pages" / "tracks(0).gpx", tmp_path / "data")
+    MetricDbscan(str(tmp_path / "results"), OSMTraces(str(tmp_path / "data"), bbox, incremental=True), 30.0, 5)
+    shutil.copy(tmp_path / "pages" / "tracks(1).gpx", tmp_path / "data")
+    traces = OSMTraces(str(tmp_path / "data"), bbox, incremental=True)
+    assert traces.base is not None
+    try:
+        configure(record=True, quiet=True)
+        updated = MetricDbscan(str(tmp_path / "results"), traces, 30.0, 5)
+        stages = recorder().stages()
+    finally:
+        configure(quiet=True)
+    assert "dbscan_update" in stages and "dbscan_fit" not in stages
+    stored = updated.load()
+    assert_same_clustering(traces.points.projected, 30.0, 5, stored["clusters"], stored["core"])
@@ -0,0 +1,131 @@
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from src.download import EMPTY_GPX, Downloader
+
+PAGE_SIZE = 3
+
+
+def gpx(points, start=0):
+    trkpts = "".join(
+        f'<trkpt lat="10.80{i:03d}" lon="106.70{i:03d}"><time>2020-01-01T00:00:{i % 60:02d}Z</time></trkpt>'
+        for i in range(start, start + points)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n<gpx version="1.0" xmlns="http://www.topografix.com/GPX/1/0">'
+        f"<trk><trkseg>{trkpts}</trkseg></trk></gpx>\n"
+    ).encode()
+
+
+class TrackpointsAPI(ThreadingHTTPServer):
+    # offline stand-in for the trackpoints API over real HTTP: pages of up to PAGE_SIZE points, an
+    # empty document past the last page, and scripted error statuses before a page is served
+    def __init__(self, sizes, failures=None):
+        self.pages = [gpx(size, PAGE_SIZE * page) for page, size in enumerate(sizes)]
+        self.failures = failures or {}
+        self.requests = []
+        super().__init__(("127.0.0.1", 0), _Handler)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/api/0.6/trackpoints?bbox=0,0,1,1"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        page = int(parse_qs(urlparse(self.path).query)["page"][0])
+        self.server.requests.append(page)
+        if self.server.failures.get(page):
+            self.send_error(self.server.failures[page].pop(0))
+            return
+        body = self.server.pages[page] if page < len(self.server.pages) else EMPTY_GPX
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api(request):
+    server = TrackpointsAPI(*request.param)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def downloader(root, api, **kwargs):
+    return Downloader(str(root), api.url, page_size=PAGE_SIZE, backoff=0, workers=2, **kwargs)
+
+
+def pages(root):
+    return sorted(name for name in os.listdir(root) if name.endswith(".gpx"))
+
+
+@pytest.mark.parametrize("api", [([3, 3, 1],)], indirect=True)
+def test_pages_until_a_short_page(tmp_path, api):
+    downloader(tmp_path, api).run()
+    assert pages(tmp_path) == ["tracks(0).gpx", "tracks(1).gpx", "tracks(2).gpx"]
+    assert downloader(tmp_path, api).is_complete()
+
+
+@pytest.mark.parametrize("api", [([3, 3],)], indirect=True)
+def test_full_last_page_ends_at_the_empty_document(tmp_path, api):
+    downloader(tmp_path, api).run()
+    assert pages(tmp_path) == ["tracks(0).gpx", "tracks(1).gpx"]
+    assert downloader(tmp_path, api).is_complete()
+
+
+@pytest.mark.parametrize("api", [([3, 3, 1], {1: [503, 429]})], indirect=True)
+def test_transient_errors_are_retried(tmp_path, api):
+    downloader(tmp_path, api).run()
+    assert api.requests.count(1) == 3
+    assert pages(tmp_path) == ["tracks(0).gpx", "tracks(1).gpx", "tracks(2).gpx"]
+
+
+@pytest.mark.parametrize("api", [([3, 3, 1], {1: [404]})], indirect=True)
+def test_client_errors_are_not_retried(tmp_path, api):
+    with pytest.raises(HTTPError):
+        downloader(tmp_path, api).run()
+    assert api.requests.count(1) == 1
+    assert not downloader(tmp_path, api).is_complete()
+
+
+@pytest.mark.parametrize("api", [([3, 3, 3, 3, 2],)], indirect=True)
+def test_max_pages_leaves_the_download_open(tmp_path, api):
+    downloader(tmp_path, api, max_pages=2).run()
+    assert pages(tmp_path) == ["tracks(0).gpx", "tracks(1).gpx"]
+    assert not downloader(tmp_path, api).is_complete()
+
+    api.requests.clear()
+    downloader(tmp_path, api, max_pages=None).run()
+    assert len(pages(tmp_path)) == 5
+    assert min(api.requests) == 2  # pages on disk are not fetched again
+    assert downloader(tmp_path, api).is_complete()
+
+
+@pytest.mark.parametrize("api", [([3, 3, 1],)], indirect=True)
+def test_refresh_fetches_the_short_last_page_again(tmp_path, api):
+    downloader(tmp_path, api).run()
+    with open(tmp_path / "tracks(2).gpx", "rb") as f:
+        assert f.read() == api.pages[2]
+
+    # the last page fills up and a new one follows
+    api.pages[2:] = [gpx(3, 6), gpx(2, 9)]
+    api.requests.clear()
+    downloader(tmp_path, api).run(refresh=True)
+    assert 0 not in api.requests and 1 not in api.requests
+    assert pages(tmp_path) == ["tracks(0).gpx", "tracks(1).gpx", "tracks(2).gpx", "tracks(3).gpx"]
+    with open(tmp_path / "tracks(2).gpx", "rb") as f:
+        assert f.read() == api.pages[2]
+    assert downloader(tmp_path, api).is_complete()
@@ -0,0 +1,72 @@
+import os
+
+from src.cache import evict
+from src.evaluation import Evaluation
+from src.scoring import Scoring
+from src.model import Model
+from src.pipeline import SUMMARY_FILE_NAME
+from src.solutions import Solution, Tca
+
+
+def write(path, size, mtime):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"0" * size)
+    os.utime(path, (mtime, mtime))
+
+
+def test_evict_shares_one_budget_across_patterns(tmp_path):
+    write(tmp_path / "osm_traces_a.pkl", 100, 1)
+    write(tmp_path / "pages" / "page_a.pkl", 100, 2)
+    write(tmp_path / "pages" / "page_b.pkl", 100, 3)
+    write(tmp_path / "osm_traces_b.pkl", 100, 4)
+    write(tmp_path / "tracks(0).gpx", 1000, 0)
+    evict(str(tmp_path), 200, ("osm_traces_*.pkl", os.path.join("pages", "page_*.pkl")))
+    assert sorted(os.listdir(tmp_path)) == ["osm_traces_b.pkl", "pages", "tracks(0).gpx"]
+    assert os.listdir(tmp_path / "pages") == ["page_b.pkl"]
+
+
+def test_evict_keeps_summary_and_model(tmp_path):
+    write(tmp_path / SUMMARY_FILE_NAME, 100, 1)
+    write(tmp_path / Model.FILE_NAME, 100, 2)
+    write(tmp_path / "tca_100_200_a.npz", 100, 3)
+    write(tmp_path / "dbscan_m_30.0_5_a.npz", 100, 4)
+    write(tmp_path / "dbscan_0.00030_5_a.npz", 100, 5)
+    evict(str(tmp_path), 100, Solution.CACHE_PATTERNS)
+    assert sorted(os.listdir(tmp_path)) == ["dbscan_0.00030_5_a.npz", Model.FILE_NAME, SUMMARY_FILE_NAME]
+
+
+def evaluation(solution_class, max_cells=None):
+    # the key and bookkeeping methods only, without running a search
+    evaluation = Evaluation.__new__(Evaluation)
+    evaluation.SolutionClass = solution_class
+    evaluation.scoring = Scoring()
+    evaluation.cells = {}
+    if max_cells is not None:
+        evaluation.MAX_CELLS = max_cells
+    return evaluation
+
+
+def test_cell_key_covers_every_solution_parameter(traces):
+    key = evaluation(Tca).cell_key(traces, 100, 200)
+
+    class LongerStops(Tca):
+        MINUTES = 20
+
+    LongerStops.__name__ = Tca.__name__
+    assert evaluation(LongerStops).cell_key(traces, 100, 200) != key
+
+    class NearFlows(Tca):
+        MAX_DISTANCE = 50
+
+    NearFlows.__name__ = Tca.__name__
+    assert evaluation(NearFlows).cell_key(traces, 100, 200) != key
+
+
+def test_cells_drop_the_least_recently_used():
+    e = evaluation(Tca, max_cells=2)
+    e.remember("a", 1)
+    e.remember("b", 2)
+    e.remember("a", 1)
+    e.remember("c", 3)
+    assert list(e.cells) == ["a", "c"]
@@ -0,0 +1,34 @@
+import tracemalloc
+
+from src import instrumentation
+from src.instrumentation import configure, profile, recorder, settings, span
+
+
+def test_profile_without_recording(tmp_path):
+    try:
+        configure(quiet=True, profile_dir=str(tmp_path))
+        with span("cell"), profile("cell"):
+            sum(range(1000))
+        assert recorder() is None
+        assert (tmp_path / "cell.prof").exists()
+        # worker processes get the same split
+        assert settings() == {
+            "record": False, "quiet": True, "trace_memory": False, "profile_dir": str(tmp_path), "profiler": "cprofile",
+        }
+        configure(**settings())
+        assert recorder() is None and instrumentation._profile_dir == str(tmp_path)
+    finally:
+        configure(quiet=True)
+
+
+def test_trace_memory_is_passed_on(tmp_path):
+    try:
+        configure(record=True, quiet=True, trace_memory=True)
+        with span("cell"):
+            bytearray(1 << 20)
+        assert "traced_peak_mb" in recorder().stages()["cell"]
+        configure(**settings())
+        assert recorder().trace_memory and instrumentation._profile_dir is None
+    finally:
+        tracemalloc.stop()
+        configure(quiet=True)
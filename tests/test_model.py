@@ -0,0 +1,43 @@
+import asyncio
+
+import numpy as np
+
+from src.model import Model
+from src.service import MicroBatcher
+from src.solutions import MetricDbscan, Tca
+
+
+def test_model_round_trip_reproduces_the_labels(tmp_path, traces):
+    tca = Tca(str(tmp_path), traces, 100, 200)
+    dbscan = MetricDbscan(str(tmp_path), traces, 30.0, 5)
+    model = Model.load(Model.from_solutions(tca, dbscan).save(str(tmp_path / Model.FILE_NAME)))
+    labels = model.predict(traces.points.xy)
+
+    np.testing.assert_array_equal(labels["weight"], tca.labels_)
+    assert np.all((labels["flow"] >= 0) == (tca.labels_ >= 0))
+    # cores and noise as DBSCAN labelled them; a border point reached by two clusters may take either
+    core, clusters = dbscan.core_and_clusters()
+    np.testing.assert_array_equal(labels["cluster"][core], clusters[core])
+    np.testing.assert_array_equal(labels["size"][core], dbscan.labels_[core])
+    np.testing.assert_array_equal(labels["cluster"] == -1, clusters == -1)
+
+
+def test_micro_batcher_returns_every_request_its_own_labels(tmp_path, traces):
+    model = Model.from_solutions(Tca(str(tmp_path), traces, 100, 200), MetricDbscan(str(tmp_path), traces, 30.0, 5))
+    requests = np.array_split(traces.points.xy[:2000], 37)
+
+    async def run():
+        batcher = MicroBatcher(model, max_points=256)
+        task = asyncio.create_task(batcher.run())
+        try:
+            return await asyncio.gather(*(batcher.submit(xy) for xy in requests)), batcher.batches
+        finally:
+            task.cancel()
+            batcher.close()
+
+    results, batches = asyncio.run(run())
+    assert 1 < batches < len(requests)
+    for xy, result in zip(requests, results):
+        expected = model.predict(xy)
+        for name, values in expected.items():
+            np.testing.assert_array_equal(result[name], values)
@@ -0,0 +1,19 @@
+import numpy as np
+
+from sklearn.metrics import pairwise_distances, silhouette_score
+
+from src.scoring import Scoring
+
+
+def test_sample_silhouette_without_a_distance_matrix(traces):
+    X = traces.points.projected
+    strata = traces.points.traj_id
+    labels = np.digitize(X[:, 0], np.quantile(X[:, 0], [0.25, 0.5, 0.75]))
+    labels[::7] = -1
+    scoring = Scoring(mode="sample", sample_size=1000, working_memory=1)
+    sample = scoring.sample(strata)
+    assert 0 < len(sample) < len(X)
+    expected = silhouette_score(pairwise_distances(X[sample]), labels[sample], metric="precomputed")
+    np.testing.assert_allclose(scoring.silhouette(X, labels, strata), expected, rtol=1e-9)
+    # cells on the same points reuse the sample
+    np.testing.assert_array_equal(scoring._sample, sample)
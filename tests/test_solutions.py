@@ -0,0 +1,49 @@
+import geopandas as gpd
+import numpy as np
+
+from shapely import LineString
+
+from src.solutions import Tca
+
+
+def nested_loop_merge(flows):
+    # the merge Tca.merge_flows replaces: every flow absorbs the later flows that are its reverse
+    merged_flows = []
+    visited = set()
+    for i, row_i in flows.iterrows():
+        if i in visited:
+            continue
+        line_i = row_i["geometry"]
+        weight = row_i["weight"]
+        obj_weight = row_i["obj_weight"]
+        for j, row_j in flows.iterrows():
+            line_j = row_j["geometry"]
+            if i != j and j not in visited and line_i.equals(LineString(line_j.coords[::-1])):
+                weight += row_j["weight"]
+                obj_weight += row_j["obj_weight"]
+                visited.add(j)
+        merged_flows.append({"geometry": line_i, "weight": weight, "obj_weight": obj_weight})
+    return gpd.GeoDataFrame(merged_flows)
+
+
+def merged(flows):
+    tca = Tca.__new__(Tca)  # merge_flows only reads and writes the flows
+    tca.flows = flows.copy()
+    tca.merge_flows()
+    return tca.flows
+
+
+def test_merge_flows_matches_nested_loop(flows):
+    expected, actual = nested_loop_merge(flows), merged(flows)
+    assert len(actual) == len(expected) < len(flows)
+    assert actual.geometry.geom_equals_exact(expected.geometry, 0).all()
+    for column in ("weight", "obj_weight"):
+        np.testing.assert_array_equal(actual[column].to_numpy(), expected[column].to_numpy())
+
+
+def test_merge_flows_keeps_the_first_direction():
+    forward, backward, other = LineString([(0, 0), (1, 1)]), LineString([(1, 1), (0, 0)]), LineString([(0, 0), (2, 0)])
+    flows = gpd.GeoDataFrame({"weight": [1, 2, 4], "obj_weight": [1, 1, 2]}, geometry=[backward, other, forward])
+    expected, actual = nested_loop_merge(flows), merged(flows)
+    assert actual.geometry.geom_equals_exact(expected.geometry, 0).all()
+    assert actual["weight"].tolist() == expected["weight"].tolist() == [5, 2]
@@ -0,0 +1,58 @@
+import os
+
+from itertools import islice
+
+import numpy as np
+
+from benchmarks.synthetic import SyntheticTraces
+from src.download import LocalTransport
+from src.instrumentation import configure, recorder
+from src.solutions import MetricDbscan, Tca
+from src.traces import OSMTraces
+from tests.test_dbscan import assert_same_clustering
+
+
+def test_no_pages_loads_an_empty_dataset(tmp_path):
+    traces = OSMTraces(str(tmp_path), (0.0, 0.0, 0.001, 0.001))
+    assert list(traces.raw.columns) == OSMTraces.RAW_COLUMNS + ["geometry"]
+    assert len(traces.raw) == 0
+    assert len(traces.trajectories) == 0
+
+
+class FirstTracks(SyntheticTraces):
+    # the first n_tracks tracks of a larger synthetic dataset, so a smaller dataset is a prefix of a larger one
+    def __init__(self, n_tracks, **kwargs):
+        super().__init__(20000, **kwargs)
+        self.n_tracks = n_tracks
+
+    def tracks(self):
+        return islice(super().tracks(), self.n_tracks)
+
+
+def test_refresh_of_a_grown_last_page_updates_the_solutions(tmp_path):
+    # the API's last page fills up with new tracks and a new page follows; the refresh fetches both
+    for name, n_tracks in (("v1", 12), ("v2", 20)):
+        bbox = FirstTracks(n_tracks, seed=5).write(str(tmp_path / name))
+    assert len(list((tmp_path / "v1").iterdir())) < len(list((tmp_path / "v2").iterdir()))
+    transport = LocalTransport(str(tmp_path / "v1"))
+    data, results = str(tmp_path / "data"), str(tmp_path / "results")
+    os.makedirs(results)
+    old = OSMTraces(data, bbox, download=True, transport=transport, incremental=True)
+    tca = Tca(results, old, 100, 200)
+    MetricDbscan(results, old, 30.0, 5)
+
+    transport.directory = str(tmp_path / "v2")
+    try:
+        configure(record=True, quiet=True)
+        new = OSMTraces(data, bbox, download=True, transport=transport, incremental=True)
+        assert new.base is not None and len(new.base.trajectories) == len(old.trajectories)
+        updated_tca = Tca(results, new, 100, 200)
+        updated_dbscan = MetricDbscan(results, new, 30.0, 5)
+        stages = recorder().stages()
+    finally:
+        configure(quiet=True)
+    assert "aggregate" not in stages and "dbscan_fit" not in stages and "dbscan_update" in stages
+    assert len(updated_tca.labels_) == len(new.points)
+    np.testing.assert_array_equal(updated_tca.labels_[:len(old.points)], tca.labels_)
+    stored = updated_dbscan.load()
+    assert_same_clustering(new.points.projected, 30.0, 5, stored["clusters"], stored["core"])
@@ -0,0 +1,45 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+
+from shapely import LineString, Point
+
+from src.utils import FlowGrid, FlowIndex
+
+
+def find_closest_segment(gdf, point):
+    # the per-point lookup FlowIndex replaces
+    distances = gdf["geometry"].apply(lambda flow: flow.distance(point))
+    return gdf.at[distances.idxmin(), "weight"]
+
+
+def test_flow_index_matches_per_point_lookup(traces, flows):
+    points = traces.points.geometry[::10]
+    expected = [find_closest_segment(flows, point) for point in points]
+    np.testing.assert_array_equal(FlowIndex(flows).query(points), expected)
+
+
+def test_flow_index_resolves_ties_to_the_first_flow():
+    flows = gpd.GeoDataFrame(
+        {"weight": [3, 7, 5]},
+        geometry=[LineString([(0, 1), (2, 1)]), LineString([(0, -1), (2, -1)]), LineString([(0, 3), (2, 3)])],
+    )
+    points = [Point(1, 0), Point(1, 2), Point(5, 5)]
+    expected = [find_closest_segment(flows, point) for point in points]
+    assert FlowIndex(flows).query(points).tolist() == expected == [3, 3, 5]
+
+
+@pytest.mark.parametrize("max_distance", [None, 0.0003])
+def test_flow_grid_matches_flow_index(traces, flows, max_distance):
+    # the trace points, points around and outside the grid, and points on the flow vertices
+    rng = np.random.default_rng(0)
+    x0, y0, x1, y1 = shapely.total_bounds(flows.geometry.values)
+    around = rng.uniform([x0 - 0.003, y0 - 0.003], [x1 + 0.003, y1 + 0.003], (20000, 2))
+    xy = np.concatenate([traces.points.xy, around, shapely.get_coordinates(flows.geometry.values)])
+    grid = FlowGrid.build(flows)
+    expected = FlowIndex(flows).nearest(shapely.points(xy), max_distance)
+    np.testing.assert_array_equal(grid.nearest(xy, max_distance), expected)
+    # as batches of a few points, the way the service queries it
+    batches = [grid.nearest(batch, max_distance) for batch in np.array_split(xy, 500)]
+    np.testing.assert_array_equal(np.concatenate(batches), expected)